@@ -1,14 +1,14 @@
+import time
+STARTED = time.perf_counter()
+
 import streamlit as st
-import pandas as pd
 from datetime import datetime, date
-from github import Github
-import io
-import yfinance as yf
-import time
-import math
+import perf
 
 # --- 0. 設定・セキュリティ ---
 st.set_page_config(page_title="成功報酬帳簿", layout="wide")
+# 計測ログ (1行1件の JSON) のレベル。"WARNING" にすると出さない
+perf.configure(st.secrets["general"].get("PERF_LOG_LEVEL", "INFO"))
 
 def check_password():
     if 'user_role' not in st.session_state:
@@ -44,259 +44,571 @@ if not check_password(): st.stop()
 
 IS_ADMIN = (st.session_state['user_role'] == "admin")
 
+# 重いモジュール (pandas / pyarrow) はログイン画面を出してから読み込む。yfinance と PyGithub は使う処理の中で読み込む
+with perf.span("import"):
+    import pandas as pd
+    import io
+    from quotes import QuoteEngine, QuoteStore
+    from history import PriceHistory, mark_to_market, position_events
+    from simulator import DEFAULT_RATES, needed_labels, onkabu_grid, parse_rates, scenario
+    from valuation import fee_summary, holdings_frame, quotes_frame, value_holdings, format_holdings
+    from past import normalize_past, past_stats, past_styles
+    from archive import archive_index, filter_archive, filter_log, frame_hash, page_bounds
+    from importer import fill_names, normalize_import, read_import
+    from market import TseCalendar
+    from columnar import frame_to_arrow, read_table, trades_from_table, trades_to_arrow
+    from ledger import KINDS, LedgerConflict, LedgerEngine, LedgerStore, Trade, TradeType, LOG_COLUMNS, EDITABLE_COLUMNS, portfolio_from_csv, trade_to_json, trades_frame, trades_from_csv, trades_from_jsonl, to_sen
+    from localstate import LocalSnapshot
+    from storage import StorageError, GitHubClient, read_buffer, GitHubStorage, LocalStorage, ReplicatedStorage, WriteBehindStorage
+
+EVENTS_FILE = 'trade_events.jsonl'
+TRADE_TABLE = 'trade_log.arrow'
+PAST_TABLE = 'past_data.arrow'
+
 # --- 1. 関数群 ---
 
-def get_github_repo():
+@st.cache_resource(show_spinner=False)
+def get_fake_repo(path):
+    from fakes import FakeRepo
+    return FakeRepo.from_dir(path)
+
+@st.cache_resource(show_spinner=False)
+def get_github_client():
+    conf = st.secrets["general"]
+    if "GITHUB_TOKEN" not in conf or "REPO_NAME" not in conf: return None
+    return GitHubClient(
+        conf["GITHUB_TOKEN"], conf["REPO_NAME"],
+        pool_size=conf.get("GITHUB_POOL_SIZE", 8),
+        retries=conf.get("GITHUB_RETRIES", 5),
+        min_remaining=conf.get("GITHUB_MIN_REMAINING", 50),
+        write_interval=conf.get("GITHUB_WRITE_INTERVAL", 1.0),
+    )
+
+def github_repo_factory():
+    # FAKE_REPO_DIR を設定するとフォルダ内の CSV を使うオフライン用の代役に切り替わる
+    fake_dir = st.secrets["general"].get("FAKE_REPO_DIR")
+    if fake_dir:
+        repo = get_fake_repo(fake_dir)
+        return lambda: repo
+    client = get_github_client()
+    return client.repo if client else (lambda: None)
+
+@st.cache_resource(show_spinner=False)
+def get_quote_engine():
+    conf = st.secrets["general"]
+    store = QuoteStore(conf.get("QUOTE_CACHE_PATH", ".cache/quotes.sqlite3"), max_entries=conf.get("QUOTE_CACHE_SIZE", 500))
+    return QuoteEngine(
+        store=store,
+        ttl=conf.get("QUOTE_TTL", 300),
+        name_ttl=conf.get("QUOTE_NAME_TTL", 30 * 86400),
+        max_workers=conf.get("QUOTE_WORKERS", 8),
+        rate=conf.get("QUOTE_RATE", 8.0),
+        burst=conf.get("QUOTE_BURST", 8),
+        refresh_interval=conf.get("QUOTE_REFRESH_SECONDS", 30),
+        calendar=TseCalendar(closed_days=conf.get("MARKET_CLOSED_DAYS", []), settle=conf.get("QUOTE_SETTLE_SECONDS", 1200)),
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_price_history():
+    conf = st.secrets["general"]
+    return PriceHistory(conf.get("PRICE_HISTORY_PATH", ".cache/prices.parquet"), ttl=conf.get("QUOTE_TTL", 300))
+
+def get_stock_name(code):
+    return get_quote_engine().get_name(code)
+
+@st.cache_resource(show_spinner=False)
+def get_storage():
+    # STORAGE_BACKEND = "github"（既定）/ "local"。local のときは REPLICATE_TO_GITHUB で GitHub へ複製する。
+    # WRITE_BEHIND_SECONDS を指定すると GitHub への書き込みをまとめて後から流す
+    conf = st.secrets["general"]
+    github = GitHubStorage(github_repo_factory(), check_interval=conf.get("VERSION_CHECK_SECONDS", 5.0))
+    delay = conf.get("WRITE_BEHIND_SECONDS", 0)
+    if delay: github = WriteBehindStorage(github, delay)
+    if conf.get("STORAGE_BACKEND", "github") != "local": return github
+
+    local = LocalStorage(conf.get("LOCAL_DATA_DIR", ".data"))
+    return ReplicatedStorage(local, github) if conf.get("REPLICATE_TO_GITHUB", False) else local
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def parse_file(filename, version, _storage):
+    # 解析結果を (ファイル名, 版) ごとにセッションをまたいで使い回す。版が変わったときだけ読み直す
+    data = _storage.read(filename, version)
+    if data is None: return None
+    # trade_log.csv とイベントログは (Trade のリスト, 読み込めない行の表)
+    if filename == EVENTS_FILE: return trades_from_jsonl(data.decode("utf-8"))
+
+    if filename == 'portfolio.csv': return portfolio_from_csv(data)
+    if filename == 'past_data.csv': return pd.read_csv(io.BytesIO(data), encoding="utf-8")
+    return trades_from_csv(data)
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def open_table(filename, version, _storage):
+    # Arrow ファイルは解析済みの表を全セッションで共有する (コピーしない)。版が変わったときだけ開き直す
+    data = read_buffer(_storage, filename, version)
+    return None if data is None else read_table(data)
+
+def read_file(filename, parse=parse_file):
+    # 読み込みの失敗 (StorageError / 解析の失敗) はそのまま例外にする。ファイルが無ければ None
+    storage = get_storage()
+    version = storage.version(filename)
+    return parse(filename, version, storage) if version else None
+
+def load_file(filename, empty, parse=parse_file):
     try:
-        token = st.secrets["general"]["GITHUB_TOKEN"]
-        repo_name = st.secrets["general"]["REPO_NAME"]
-        return Github(token).get_repo(repo_name)
-    except: return None
-
-@st.cache_data(ttl=300, show_spinner=False)
-def get_stock_info(code):
-    code = str(code).strip()
-    if code in ["ADJUST", "PAYMENT"]: return "システム調整", 0, 0, 0
+        parsed = read_file(filename, parse)
+    except StorageError as e:
+        st.error(f"⚠️ {e}")
+        return empty
+    except Exception as e:
+        st.error(f"⚠️ {filename} を読み込めませんでした: {e}")
+        return empty
+    return empty if parsed is None else parsed
+
+def load_csv(filename):
+    return load_file(filename, [] if filename == 'past_data.csv' else {})
+
+def load_table(filename):
+    # ファイルが無ければ None
+    return load_file(filename, None, open_table)
+
+def load_trades():
+    # trade_log.arrow を優先し、まだ無ければ trade_log.csv から読む。(Trade のリスト, 読み込めない行の表)。
+    # 読み込めなければ例外 (空の帳簿として扱わない)
+    table = read_file(TRADE_TABLE, open_table)
+    if table is not None: return trades_from_table(table)
+    return read_file('trade_log.csv') or ([], None)
+
+def load_past_data():
+    table = load_table(PAST_TABLE)
+    return table.to_pandas() if table is not None else load_csv('past_data.csv')
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def value_portfolio(holdings, quotes):
+    # 保有と株価が前回と同じなら再計算しない
+    return value_holdings(holdings, quotes)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def get_position_events(log_hash, _trades):
+    return position_events(_trades)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def get_archive_index(log_hash, _df_log):
+    # 取引履歴が変わらない限り (ハッシュが同じ間は) 銘柄別の集計をやり直さない
+    return archive_index(_df_log)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def get_past_view(past_hash, _past_df):
+    # past_data の型の変換・色付け・集計は、内容 (ハッシュ) が変わらない限りやり直さない
+    past = normalize_past(_past_df)
+    return past, past_styles(past), past_stats(past)
+
+def portfolio_frame(portfolio):
+    return pd.DataFrame.from_dict(portfolio, orient='index').reset_index().rename(columns={'index':'Code'})
+
+def save_files(frames, message):
+    # 複数のファイル (DataFrame は CSV にする) をまとめて1回で保存する。失敗したら画面に表示して False を返す
+    if not IS_ADMIN: return False
+    files = {filename: df if isinstance(df, (str, bytes)) else df.to_csv(index=False) for filename, df in frames.items()}
     try:
-        ticker = yf.Ticker(f"{code}.T")
-        name = ticker.info.get('longName')
-        if not name: name = ticker.info.get('shortName')
-        if not name: name = f"コード({code})"
-        
-        price = ticker.fast_info.last_price
-        prev_close = ticker.fast_info.previous_close
-        
-        if price is None or price == 0:
-            hist = ticker.history(period="1d")
-            if not hist.empty:
-                price = hist['Close'].iloc[-1]
-                prev_close = price
-        
-        if price is None: price = 0
-        if prev_close is None: prev_close = 0
-
-        change = 0
-        pct_change = 0
-        if price > 0 and prev_close > 0:
-            change = price - prev_close
-            pct_change = (change / prev_close) * 100
-            
-        return name, price, change, pct_change
-    except:
-        return f"コード({code})", 0, 0, 0
-
-def load_csv_from_github(filename):
-    repo = get_github_repo()
-    if not repo: return [] if filename == 'trade_log.csv' or filename == 'past_data.csv' else {}
-    
+        with perf.span("save", files=list(files)):
+            get_storage().write(files, message)
+        return True
+    except StorageError as e:
+        st.error(f"⚠️ {e}")
+        return False
+
+def skipped_frame(*frames):
+    # 読み込めなかった行をまとめる。無ければ None
+    frames = [f for f in frames if f is not None and len(f)]
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+def snapshot_blocked(state, notify=True):
+    # 読み込めなかった行が残っているあいだは trade_log を書き直さない (書き直すとその行が消える)
+    if state.skipped is None: return False
+    if notify: st.error(f"⚠️ trade_log に読み込めない行が {len(state.skipped):,} 件あります。CSV を直して「CSV から Arrow を作り直す」を実行してください")
+    return True
+
+def save_trade(trade, engine, state):
+    # 取引はイベントログに1行追記するだけにし、COMPACT_EVERY 件たまったらスナップショットに畳み込む。
+    # 戻り値は LedgerStore.write に返す (event_count, sources)。保存できなければ None
+    event_count = state.event_count + 1
+    if event_count >= st.secrets["general"].get("COMPACT_EVERY", 50) and not snapshot_blocked(state, notify=False):
+        return save_snapshot(engine.portfolio, engine.trades, "Compact trade events")
+    if not IS_ADMIN: return None
     try:
-        file = repo.get_contents(filename)
-        if filename != 'past_data.csv':
-            st.session_state[f'{filename}_sha'] = file.sha
-        
-        csv_data = file.decoded_content.decode("utf-8")
-        df = pd.read_csv(io.StringIO(csv_data))
-        
-        if filename == 'portfolio.csv':
-            df['Code'] = df['Code'].astype(str)
-            return df.set_index('Code').to_dict(orient='index')
-        elif filename == 'past_data.csv':
-            return df
+        with perf.span("save", files=[EVENTS_FILE]):
+            get_storage().append(EVENTS_FILE, trade_to_json(trade), f"{trade.kind.label}: {trade.code}")
+        return event_count, None
+    except StorageError as e:
+        st.error(f"⚠️ {e}")
+        return None
+
+def save_snapshot(portfolio, trades, message, extra=None):
+    # trade_log.arrow / portfolio.csv を書き直し、同じ書き込みでイベントログを空にする。
+    # CSV_MIRROR が有効なら (既定) 人が読めるように trade_log.csv も並べて書く
+    files = {'portfolio.csv': portfolio_frame(portfolio), TRADE_TABLE: trades_to_arrow(trades), EVENTS_FILE: "", **(extra or {})}
+    if st.secrets["general"].get("CSV_MIRROR", True): files['trade_log.csv'] = trades_frame(trades)
+    return (0, None) if save_files(files, message) else None
+
+@st.cache_resource(show_spinner=False)
+def get_local_snapshot():
+    return LocalSnapshot(st.secrets["general"].get("LOCAL_STATE_DIR", ".cache/state"))
+
+@st.cache_resource(show_spinner=False)
+def get_ledger_store():
+    # 帳簿はプロセスで1つ。読み込み・保存先との突き合わせもここで1回だけ行い、各セッションは版を受け取るだけにする
+    return LedgerStore()
+
+def remote_versions():
+    # 復元に使うファイルの保存先での版。つながらなければ StorageError
+    storage = get_storage()
+    return {name: storage.version(name) for name in (TRADE_TABLE, 'trade_log.csv', 'portfolio.csv', EVENTS_FILE)}
+
+def load_state():
+    # スナップショット (CSV) に、まだ畳み込まれていないイベントを足して復元し、新しい版として公開する。
+    # どれかが読めなければ例外のまま返し、何も公開しない (次のセッション・再実行で読み直す)。
+    # 読み込めたら手元のスナップショットにも残し、次の起動ではそれを先に表示する
+    versions = remote_versions()
+    portfolio = read_file('portfolio.csv') or {}
+    trades, skipped = load_trades()
+    events, bad_events = read_file(EVENTS_FILE) or ([], None)
+    skipped = skipped_frame(skipped, bad_events)
+    engine = None
+    if events:
+        with perf.span("ledger.build", rows=len(trades) + len(events)):
+            engine = LedgerEngine(trades)
+            for trade in events: engine.append(trade)
+        portfolio, trades = engine.portfolio, engine.trades
+    state = get_ledger_store().publish(portfolio, trades, len(events), versions, engine, skipped)
+    get_local_snapshot().save(portfolio, state.trades, versions, len(events), skipped)
+    return state
+
+def load_local_state():
+    # 手元のスナップショットで先に表示する。保存先との突き合わせは描画のあとに reconcile_state で行い、
+    # それまでは書き込めない版として公開する
+    saved = get_local_snapshot().load()
+    if saved is None: return None
+    portfolio, trades, versions, event_count, skipped = saved
+    return get_ledger_store().publish(portfolio, trades, event_count, versions, skipped=skipped, verified=False)
+
+def sync_state():
+    # 公開中の版がこのセッションの版と違うときだけ取り替える (中身は写さず、全セッションで同じものを見る)
+    s = st.session_state
+    state = get_ledger_store().current
+    if state is None or s.get('state_version') == state.version: return
+    s.portfolio = state.portfolio
+    s.trade_log = state.trades
+    s.state_version = state.version
+
+def reconcile_state():
+    # 保存先の版がスナップショットのときと違えば読み直して、表示をやり直す。
+    # ほかのセッションが先に読み直していれば、その版を受け取るだけにする。
+    # 保存先につながらないときは突き合わせ前のまま (書き込めない) にしておき、次の再実行でやり直す
+    s = st.session_state
+    store = get_ledger_store()
+    state = store.current
+    try:
+        current = remote_versions()
+        if current == state.sources:
+            store.verify(state.version)
         else:
-            df['証券コード'] = df['証券コード'].astype(str)
-            df['日付'] = pd.to_datetime(df['日付']).dt.date
-            if 'ボーナス' not in df.columns: df['ボーナス'] = False
-            return df.to_dict(orient='records')
-    except:
-        return [] if filename == 'trade_log.csv' or filename == 'past_data.csv' else {}
-
-def save_to_github_fast(filename, df):
-    if not IS_ADMIN: return
-    repo = get_github_repo()
-    if not repo: return
+            with perf.span("reconcile"):
+                store.reload(load_state, state.version)
+    except Exception as e:
+        s.reconcile_error = str(e)
+        if IS_ADMIN: st.warning(f"⚠️ 保存先と突き合わせできていないため、記録・編集の保存を止めています（自動でやり直します）: {e}")
+        return
+    s.pop('reconcile_error', None)
+    if store.version != state.version:
+        sync_state()
+        st.rerun()
 
+def write_ledger(change, base=None):
+    # change(engine, state) で帳簿を書き換えて保存する。
+    # base (このセッションが見ている版) より新しい版が先に公開されていたら、書き込まずに最新の版を表示し直す
     try:
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-        content = csv_buffer.getvalue()
-        sha = st.session_state.get(f'{filename}_sha')
-        
-        if sha:
-            try:
-                commit = repo.update_file(filename, f"Update {filename}", content, sha)
-                st.session_state[f'{filename}_sha'] = commit['content'].sha
-                return
-            except: pass
-            
-        file = repo.get_contents(filename)
-        commit = repo.update_file(filename, f"Update {filename}", content, file.sha)
-        st.session_state[f'{filename}_sha'] = commit['content'].sha
-
+        state = get_ledger_store().write(change, base)
+    except LedgerConflict as e:
+        st.toast(f"⚠️ {e}")
+        sync_state()
+        st.session_state.ledger_changed = True
+        return False
+    if state is None: return False
+    sync_state()
+    st.session_state.ledger_changed = True
+    return True
+
+def rebuild_tables():
+    # 手で直した CSV を反映する: trade_log.csv (+ 未反映のイベント) から再計算し、Arrow ファイルを書き直す
+    try:
+        trades, skipped = read_file('trade_log.csv') or ([], None)
+        events, bad_events = read_file(EVENTS_FILE) or ([], None)
     except Exception as e:
-        try:
-            repo.create_file(filename, f"Create {filename}", content)
-        except: pass
-
-def recalculate_all(logs):
-    sorted_logs = sorted(logs, key=lambda x: x['日付'])
-    portfolio = {}
-    processed_logs = []
-
-    for log in sorted_logs:
-        code = str(log['証券コード']).strip()
-        trade_type = log['区分']
-        is_bonus = log.get('ボーナス', False)
-        
-        if trade_type in ["データ調整", "報酬精算"]:
-            processed_logs.append(log)
-            continue
-
-        qty = int(log['数量'])
-        price = float(log['約定単価'])
-        
-        log_name = log.get('銘柄名')
-        current_name_in_port = portfolio.get(code, {}).get('name')
-        
-        if log_name and "コード(" not in str(log_name): final_name = log_name
-        elif current_name_in_port and "コード(" not in str(current_name_in_port): final_name = current_name_in_port
-        else: final_name = str(log_name) if log_name else f"コード({code})"
-
-        if trade_type in ["買い", "新規買付", "買い増し"]:
-            if code not in portfolio:
-                portfolio[code] = {'name': final_name, 'qty': 0, 'avg_price': 0.0, 'realized_pl': 0, 'original_avg': 0.0}
-            
-            cur = portfolio[code]
-            total_cost = (cur['qty'] * cur['avg_price']) + (qty * price)
-            
-            base_avg = cur.get('original_avg', cur['avg_price'])
-            if base_avg == 0 and cur['qty'] == 0: base_avg = price
-            elif base_avg == 0 and cur['avg_price'] > 0: base_avg = cur['avg_price']
-
-            total_real_cost = (cur['qty'] * base_avg) + (qty * price)
-            total_qty = cur['qty'] + qty
-            
-            new_avg = round(total_cost / total_qty, 2) if total_qty > 0 else 0.0
-            new_real_avg = round(total_real_cost / total_qty, 2) if total_qty > 0 else 0.0
-            
-            portfolio[code].update({'qty': total_qty, 'avg_price': new_avg, 'original_avg': new_real_avg, 'name': final_name})
-            log.update({'平均単価': new_avg, '確定損益': 0, '銘柄名': final_name})
-
-        elif trade_type in ["売り", "売却"]:
-            if code in portfolio:
-                cur = portfolio[code]
-                if is_bonus:
-                    total_holding_cost = cur['qty'] * cur['avg_price']
-                    sell_amount = qty * price
-                    profit = sell_amount - total_holding_cost
-                    new_avg = 0.0
-                    portfolio[code]['qty'] = max(0, cur['qty'] - qty)
-                    portfolio[code]['avg_price'] = new_avg
-                    portfolio[code]['realized_pl'] += profit
-                    log.update({'平均単価': new_avg, '確定損益': profit, '銘柄名': portfolio[code]['name']})
-                else:
-                    profit = (price - cur['avg_price']) * qty
-                    portfolio[code]['qty'] = max(0, cur['qty'] - qty)
-                    portfolio[code]['realized_pl'] += profit
-                    log.update({'平均単価': cur['avg_price'], '確定損益': profit, '銘柄名': portfolio[code]['name']})
-        
-        processed_logs.append(log)
-    return portfolio, processed_logs
+        # 読めないまま作り直すと、空の帳簿で上書きしてしまう
+        st.error(f"⚠️ 読み込めなかったので作り直しません: {e}")
+        return False
+    skipped = skipped_frame(skipped, bad_events)
+    if skipped is not None:
+        st.error(f"⚠️ 読み込めない行が {len(skipped):,} 件あるので作り直しません。直してからもう一度実行してください")
+        st.dataframe(skipped, use_container_width=True)
+        return False
+    engine = LedgerEngine(trades)
+    for trade in events: engine.append(trade)
+    past = load_csv('past_data.csv')
+    extra = {PAST_TABLE: frame_to_arrow(past)} if isinstance(past, pd.DataFrame) and not past.empty else {}
+    if save_snapshot(engine.portfolio, engine.trades, "Rebuild Arrow tables from CSV", extra):
+        get_ledger_store().publish(engine.portfolio, engine.trades, engine=engine)
+        sync_state()
+        return True
+    return False
 
 # --- 2. イベントハンドラ ---
 
 def execute_transaction(tx_type, date_val, code_val, qty_val, price_val, is_bonus=False):
     if not IS_ADMIN: return 
 
-    s = st.session_state
-    
     with st.spinner('🚀 処理中...'):
-        if tx_type == "データ調整":
-            new_log = {
-                '日付': date_val, '区分': tx_type, '証券コード': "ADJUST",
-                '銘柄名': "📊 過去損益調整引継", '数量': 0, '約定単価': 0, '平均単価': 0,
-                '確定損益': int(price_val), 'ボーナス': False
-            }
-        elif tx_type == "報酬精算":
-            new_log = {
-                '日付': date_val, '区分': tx_type, '証券コード': "PAYMENT",
-                '銘柄名': "✅ 成功報酬精算完了", '数量': 0, '約定単価': 0, '平均単価': 0,
-                '確定損益': int(price_val), 'ボーナス': is_bonus
-            }
+        kind = KINDS[tx_type]
+        if kind == TradeType.ADJUST:
+            trade = Trade(date_val, kind, "ADJUST", "📊 過去損益調整引継", pl=to_sen(int(price_val)))
+        elif kind == TradeType.PAYMENT:
+            trade = Trade(date_val, kind, "PAYMENT", "✅ 成功報酬精算完了", pl=to_sen(int(price_val)), bonus=is_bonus)
         else:
             if not code_val or qty_val <= 0: return
             code = str(code_val).strip()
-            name, _, _, _ = get_stock_info(code)
-            new_log = {
-                '日付': date_val, '区分': tx_type, '証券コード': code, '銘柄名': name,
-                '数量': qty_val, '約定単価': price_val, '平均単価': 0, '確定損益': 0,
-                'ボーナス': is_bonus
-            }
-        
-        s.trade_log.append(new_log)
-        new_port, new_logs = recalculate_all(s.trade_log)
-        
-        save_to_github_fast('portfolio.csv', pd.DataFrame.from_dict(new_port, orient='index').reset_index().rename(columns={'index':'Code'}))
-        save_to_github_fast('trade_log.csv', pd.DataFrame(new_logs))
+            name = get_stock_name(code)
+            trade = Trade(date_val, kind, code, name, qty=int(qty_val), price=to_sen(price_val), bonus=is_bonus)
         
-        s.portfolio = new_port
-        s.trade_log = new_logs
-        st.toast("✅ 反映完了")
+        def change(engine, state):
+            with perf.span("ledger.append"):
+                engine.append(trade)
+            return save_trade(trade, engine, state)
 
+        if write_ledger(change): st.toast("✅ 反映完了")
+
+# ボタンのコールバックは入力欄を空にして取引を積むだけにする (コールバック内で描画すると画面の先頭に出てしまう)。
+# 積んだ取引は input_section の本体で実行し、結果もそこに表示する
 def handle_buy():
     s = st.session_state
-    execute_transaction("買い", s.buy_date, s.buy_code, s.buy_qty, s.buy_price, False)
+    s.pending_tx = ("買い", s.buy_date, s.buy_code, s.buy_qty, s.buy_price, False)
     s.buy_code = ""
     s.buy_price = 0.0
 
 def handle_sell():
     s = st.session_state
-    execute_transaction("売り", s.sell_date, s.sell_code, s.sell_qty, s.sell_price, s.sell_is_bonus)
+    s.pending_tx = ("売り", s.sell_date, s.sell_code, s.sell_qty, s.sell_price, s.sell_is_bonus)
     s.sell_code = ""
     s.sell_price = 0.0
     s.sell_is_bonus = False
 
 def handle_adjust():
     s = st.session_state
-    execute_transaction("データ調整", s.adj_date, "ADJUST", 0, s.adj_amount, False)
+    s.pending_tx = ("データ調整", s.adj_date, "ADJUST", 0, s.adj_amount, False)
     s.adj_amount = 0.0
 
 def handle_payment_reset(profit_amount, is_bonus_payment):
     reset_amount = -1 * profit_amount
     execute_transaction("報酬精算", date.today(), "PAYMENT", 0, reset_amount, is_bonus_payment)
 
-def handle_save_changes(edited_df):
+def _cell(v):
+    if v is None: return None
+    try:
+        if pd.isna(v): return None
+    except (TypeError, ValueError): pass
+    if isinstance(v, pd.Timestamp): return v.date()
+    if hasattr(v, 'item'): return v.item()
+    return v
+
+def _new_trade(row):
+    log = {c: _cell(row.get(c)) for c in LOG_COLUMNS}
+    if log['日付'] is None or not log['区分']: return None
+    log['証券コード'] = str(log['証券コード'] or "").strip()
+    log['ボーナス'] = bool(log['ボーナス'])
+    return Trade.from_log(log)
+
+def diff_trade_log(edited_df, source_df, trades):
+    # データエディタの内容を元の表と突き合わせ、削除・変更・追加された行に分ける。
+    # インデックスは trade_log 上の位置。比較は列単位でまとめて行う。
+    # source_df はエディタに表示した範囲だけなので、範囲外の行が削除扱いになることはない
+    cols = [c for c in EDITABLE_COLUMNS if c in edited_df.columns and c in source_df.columns]
+    flagged = edited_df['削除'].fillna(False).astype(bool) if '削除' in edited_df.columns else pd.Series(False, index=edited_df.index)
+    is_existing = edited_df.index.isin(source_df.index) & ~edited_df.index.duplicated()
+
+    kept = edited_df.index[is_existing & ~flagged.to_numpy()]
+    removed_labels = source_df.index.difference(kept)
+
+    new_vals = edited_df.loc[kept, cols]
+    old_vals = source_df.loc[kept, cols]
+    same = (new_vals == old_vals) | (new_vals.isna() & old_vals.isna())
+    changed = kept[~same.all(axis=1).to_numpy()]
+
+    removed = [trades[i] for i in removed_labels]
+    replaced = []
+    for label, row in zip(changed, edited_df.loc[changed, cols].to_dict(orient='records')):
+        old = trades[label]
+        replaced.append((old, Trade.from_log({**old.to_log(), **{c: _cell(v) for c, v in row.items()}})))
+    new_rows = edited_df[~is_existing & ~flagged.to_numpy()].to_dict(orient='records')
+    added = [trade for trade in map(_new_trade, new_rows) if trade]
+    return removed, replaced, added
+
+def handle_save_changes(edited_df, source_df):
     if not IS_ADMIN: return
 
     with st.spinner('💾 再計算中...'):
-        if '削除' in edited_df.columns:
-            valid_rows = edited_df[edited_df['削除'] == False].drop(columns=['削除'])
-        else: valid_rows = edited_df
-
-        logs = valid_rows.to_dict(orient='records')
-        new_port, new_logs = recalculate_all(logs)
-        
-        save_to_github_fast('portfolio.csv', pd.DataFrame.from_dict(new_port, orient='index').reset_index().rename(columns={'index':'Code'}))
-        save_to_github_fast('trade_log.csv', pd.DataFrame(new_logs))
-        
-        st.session_state.portfolio = new_port
-        st.session_state.trade_log = new_logs
+        removed, replaced, added = diff_trade_log(edited_df, source_df, st.session_state.trade_log)
+        if not (removed or replaced or added):
+            st.info("変更はありません")
+            return
+
+        def change(engine, state):
+            # 画面の取引 (公開中の版のもの) を、同じ並びの帳簿側の取引に置き換えてから反映する
+            if snapshot_blocked(state): return None
+            at = {id(t): i for i, t in enumerate(state.trades)}
+            mine = lambda t: engine.trades[at[id(t)]]
+            with perf.span("ledger.splice", removed=len(removed), replaced=len(replaced), added=len(added)):
+                engine.splice([mine(t) for t in removed], [(mine(old), new) for old, new in replaced], added)
+            return save_snapshot(engine.portfolio, engine.trades, "Edit trade_log")
+
+        if not write_ledger(change, base=st.session_state.get('state_version')): return
         st.success("完了！")
         time.sleep(1)
         st.rerun()
 
+def handle_import(trades):
+    # 取り込んだ取引をまとめて1回で再計算し、1回のコミットで保存する
+    if not IS_ADMIN or not trades: return
+    with st.spinner(f'📥 {len(trades):,} 件を取り込み中...'):
+        trades = fill_names(trades, get_quote_engine().get_names)
+
+        def change(engine, state):
+            if snapshot_blocked(state): return None
+            with perf.span("ledger.splice", added=len(trades)):
+                engine.splice(added=trades)
+            return save_snapshot(engine.portfolio, engine.trades, f"Import {len(trades)} trades")
+
+        if write_ledger(change):
+            st.toast(f"✅ {len(trades):,} 件を取り込みました")
+            # 取り込んだファイルがアップローダーに残ると、もう一度押したときに二重に取り込んでしまう。キーを変えて空にする
+            st.session_state.import_gen = st.session_state.get('import_gen', 0) + 1
+
+def get_valuation():
+    # 株価は待たずに手元の最新値で評価する。未取得・期限切れの銘柄は裏で取得され、次の描画で反映される
+    s = st.session_state
+    holdings = holdings_frame(s.portfolio)
+    with perf.span("quotes", codes=len(holdings)):
+        snapshot = get_quote_engine().snapshot(holdings.index)
+    quotes = {code: info for code, (info, _) in snapshot.items()}
+    status = {code: state for code, (_, state) in snapshot.items()}
+
+    with perf.span("valuation"):
+        valued = value_portfolio(holdings, quotes_frame(quotes, status))
+    s.valuation = {'valued': valued}
+    return valued
+
+def rerun_app_if_changed():
+    # 取引を記録したときは、評価額・報酬・履歴の各区画も描き直すためにページ全体を再実行する。
+    # (コールバック内では st.rerun できないので、execute_transaction が立てた印をここで見る)
+    # ほかのセッション (管理者) が新しい版を公開したときも同じで、版の番号を比べるだけで気づける
+    s = st.session_state
+    if s.pop('ledger_changed', False) or s.get('state_version') != get_ledger_store().version: st.rerun(scope="app")
+
 # --- 3. メインUI ---
 
+def pager(key, total, size):
+    # ページ送り。件数が減って今のページが無くなったときは最後のページに戻す
+    start, stop, pages = page_bounds(total, st.session_state.get(key, 1), size)
+    if pages > 1:
+        st.session_state[key] = start // size + 1
+        p1, p2 = st.columns([1, 3])
+        with p1: st.number_input("ページ", min_value=1, max_value=pages, step=1, key=key)
+        with p2: st.caption(f"{total:,} 件中 {start + 1:,}〜{stop:,} 件目 / 全 {pages} ページ")
+    return start, stop
+
 def main():
-    if 'portfolio' not in st.session_state:
-        with st.spinner('☁️ 起動中...'):
-            st.session_state.portfolio = load_csv_from_github('portfolio.csv')
-            st.session_state.trade_log = load_csv_from_github('trade_log.csv')
+    s = st.session_state
+    # 帳簿はプロセスで最初のセッションだけが読み込み、以降のセッションは公開中の版をそのまま使う
+    store = get_ledger_store()
+    source = "shared"
+    if store.current is None:
+        with perf.span("load_state.local"):
+            source = "local" if store.ensure(load_local_state) else "remote"
+        if source == "remote":
+            with st.spinner('☁️ 起動中...'), perf.span("load_state"):
+                try:
+                    store.ensure(load_state)
+                except Exception as e:
+                    st.error(f"⚠️ 帳簿を読み込めませんでした（再読み込みでやり直します）: {e}")
+                    st.stop()
+    sync_state()
 
     st.title("J_Phantom_Gear ⚙️")
     st.caption("運用レポート & 成功報酬管理")
     st.markdown("---")
 
+    storage_error = getattr(get_storage(), "last_error", None)
+    if IS_ADMIN and storage_error:
+        st.warning(f"⚠️ バックグラウンド保存に失敗しています（次の保存時に再送します）: {storage_error}")
+    skipped = store.current.skipped
+    if IS_ADMIN and skipped is not None:
+        with st.expander(f"⚠️ 読み込めない行が {len(skipped):,} 件あります（この行は計算に含めず、直すまで trade_log の書き直しを止めています）"):
+            st.dataframe(skipped, use_container_width=True)
+
+    with perf.span("render.inputs"): input_section()
+
+    st.write("")
+
+    # ▼ ポートフォリオ（スマホ対応）
+    st.subheader("📊 現在のポートフォリオ")
+    with perf.span("render.portfolio"): portfolio_section()
+    if 'first_paint' not in s:
+        # 起動 (この再実行の開始) からポートフォリオを表示し終えるまで
+        s.first_paint = (time.perf_counter() - STARTED) * 1000
+        perf.record("first_paint", s.first_paint, source=source)
+    with perf.span("render.simulator"): simulator_section()
+
+    st.write("")
+
+    # ▼ 💰 成功報酬管理
+    st.subheader("💰 成功報酬管理")
+    with perf.span("render.fees"): fee_section()
+
+    with perf.span("render.history"): history_section()
+
+    st.write("")
+
+    with st.expander("🗄️ 過去データ詳細（参照用）"):
+        past_df = load_past_data()
+        if not isinstance(past_df, list) and not past_df.empty:
+            past, styles, (by_year, overall) = get_past_view(frame_hash(past_df), past_df)
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("損益合計", f"¥{int(overall['損益']):,}")
+            c2.metric("勝率", f"{overall['勝率%']:.1f}%")
+            c3.metric("利確合計", f"¥{int(overall['利確合計']):,}")
+            c4.metric("損切合計", f"¥{int(overall['損切合計']):,}")
+            st.dataframe(by_year, use_container_width=True)
+            st.dataframe(past.style.apply(lambda _: styles, axis=None), use_container_width=True, hide_index=True,
+                         column_config={"年": st.column_config.NumberColumn(format="%d"), "日付": st.column_config.DateColumn(format="YYYY/MM/DD")})
+        else:
+            st.info("past_data.csv が見つかりません。")
+
+    st.markdown("---")
+
+    st.subheader("📜 全取引履歴 (銘柄別アーカイブ)")
+    with perf.span("render.archive"): archive_section()
+
+    if IS_ADMIN: show_diagnostics()
+
+    # 手元のスナップショットで表示したときは、描画し終えてから保存先と突き合わせる (済むまで再実行ごとにやり直す)
+    if not store.verified: reconcile_state()
+
+# --- 4. 画面の区画 ---
+# 各区画は st.fragment。区画内の操作ではその区画だけが再実行され、他の区画の株価取得や計算は走らない
+
+@st.fragment
+def input_section():
     qty_options = list(range(100, 100100, 100))
+    pending_tx = st.session_state.pop('pending_tx', None)
+    if pending_tx: execute_transaction(*pending_tx)
 
     if IS_ADMIN:
         with st.expander("🛠️ 取引入力・修正（管理者のみ表示）", expanded=False):
@@ -346,83 +658,40 @@ def main():
                 with c2: st.number_input("調整額（マイナスなら - をつけて）", step=1000.0, format="%.0f", key="adj_amount", label_visibility="collapsed")
                 with c3: st.button("調整実行", on_click=handle_adjust, use_container_width=True)
 
+            st.write("")
+
+            st.markdown("### 📥 CSV から一括取り込み")
+            st.info("trade_log.csv と同じ列（日付・区分・証券コード・数量・約定単価…）か、past_data.csv と同じ列（日付・証券コード・銘柄名・数量・損益）の CSV を取り込めます。past_data 形式の行は「データ調整」として記録します。")
+            uploaded = st.file_uploader("CSV ファイル", type=["csv"], key=f"import_file_{st.session_state.get('import_gen', 0)}", label_visibility="collapsed")
+            if uploaded is not None:
+                try:
+                    trades, errors = normalize_import(read_import(uploaded.getvalue()))
+                except Exception as e:
+                    st.error(f"⚠️ 読み込めませんでした: {e}")
+                else:
+                    st.caption(f"取り込める行: {len(trades):,} 件 / 取り込めない行: {len(errors):,} 件")
+                    if len(errors): st.dataframe(errors, use_container_width=True)
+                    if trades and st.button(f"📥 {len(trades):,} 件を取り込む", type="primary"):
+                        handle_import(trades)
+
     st.write("")
 
-    # ▼ ポートフォリオ（スマホ対応）
-    st.subheader("📊 現在のポートフォリオ")
-    
+    rerun_app_if_changed()
+
+@st.fragment(run_every=st.secrets["general"].get("QUOTE_POLL_SECONDS", 5))
+def portfolio_section():
+    # 一定間隔でこの区画だけを描き直し、裏で届いた株価を行ごとに反映する。
+    # 帳簿の新しい版が公開されていれば、ここでページ全体を描き直す。保存先との突き合わせに失敗していればここでもやり直す
+    if 'reconcile_error' in st.session_state and not get_ledger_store().verified: reconcile_state()
+    rerun_app_if_changed()
     # ★ここにスマホ用切り替えスイッチを追加！
     use_mobile_view = st.toggle("📱 スマホ用表示モード", value=True)
-    
-    total_onkabu_value = 0 
 
     if st.session_state.portfolio:
-        rows = []
-        port_options = {}
-        
-        progress_text = "株価データ取得中..."
-        my_bar = st.progress(0, text=progress_text)
-        total_items = len(st.session_state.portfolio)
-        processed_count = 0
-
-        for code, v in st.session_state.portfolio.items():
-            if v['qty'] <= 0: 
-                processed_count += 1
-                continue
-            
-            time.sleep(1)
-            
-            name, current_price, change, pct_change = get_stock_info(code)
-            port_options[code] = f"{name} ({code})"
-
-            cost = v['qty'] * v['avg_price']
-            is_data_error = (current_price == 0)
-
-            if v['avg_price'] == 0:
-                status_text = "👑 恩株 (コスト0円)"
-                if not is_data_error:
-                    total_onkabu_value += (current_price * v['qty']) 
-            else:
-                is_onkabu = v['realized_pl'] >= cost
-                if is_onkabu: status_text = "🏆完全恩株達成！"
-                else:
-                    remaining = int(cost - v['realized_pl'])
-                    status_text = f"あと{remaining:,}円"
-
-            if is_data_error:
-                current_price_disp = "⚠️ 取得失敗"
-                change_str = "---"
-                pl_str = "---"
-                pct_str = "---"
-                unrealized_pl = 0 
-            else:
-                current_price_disp = f"{int(current_price):,}円"
-                unrealized_pl = (current_price - v['avg_price']) * v['qty']
-                calc_base_price = v.get('original_avg', v['avg_price'])
-                if calc_base_price == 0: calc_base_price = v['avg_price']
-
-                unrealized_pct = 0.0
-                if calc_base_price > 0:
-                    unrealized_pct = ((current_price - calc_base_price) / calc_base_price) * 100
-                
-                mark_change = "🔺" if change > 0 else "▼" if change < 0 else "➖"
-                change_str = f"{mark_change} {int(change)} ({pct_change:+.2f}%)"
-                mark_pl = "🔺" if unrealized_pl > 0 else "▼" if unrealized_pl < 0 else "➖"
-                pl_str = f"{mark_pl} {int(unrealized_pl):,}"
-                mark_pct = "+" if unrealized_pct > 0 else ""
-                pct_str = f"{mark_pct}{unrealized_pct:.2f}%"
-
-            rows.append({
-                '証券コード': code, '銘柄名': name, '現在値': current_price_disp,
-                '前日比': change_str, '保有株数': v['qty'], '平均取得単価': f"{v['avg_price']:,.0f}",
-                '騰落率': pct_str, '含み損益': pl_str, '保有元本': f"{int(cost):,}",
-                'ステータス': status_text
-            })
-            
-            processed_count += 1
-            my_bar.progress(processed_count / total_items, text=f"データ取得中... ({name})")
-        
-        my_bar.empty()
+        valued = get_valuation()
+        rows = format_holdings(valued).to_dict('records')
+        if 'status' in valued and (valued['status'] != "fresh").any():
+            st.caption("⏳ 取得中・🕒 更新待ちの株価は、届きしだい自動で表示を更新します")
 
         if rows:
             # ★ スマホモードONなら「カード表示」にする
@@ -446,48 +715,79 @@ def main():
                 df = pd.DataFrame(rows).sort_values('証券コード')
                 df.index = range(1, len(df) + 1)
                 st.dataframe(df, use_container_width=True)
-            
-            with st.expander("📈 恩株シミュレーター（将来予測）", expanded=False):
-                st.info("保有銘柄を選択すると、上昇率ごとの「恩株化に必要な売却数（100株単位）」を計算します。")
-                selected_code_display = st.selectbox("銘柄選択", list(port_options.values()))
-                
-                if selected_code_display:
-                    selected_code = selected_code_display.split("(")[-1].replace(")", "").strip()
-                    target_data = st.session_state.portfolio[selected_code]
-                    avg = target_data['avg_price']
-                    qty = target_data['qty']
-                    realized = target_data['realized_pl']
-                    remaining_cost = (avg * qty) - realized 
-                    if remaining_cost <= 0: st.success("🎉 すでに恩株化達成済みです！")
-                    else:
-                        sim_rows = []
-                        patterns = [0, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200]
-                        for p in patterns:
-                            target_price = avg * (1 + p/100)
-                            raw_needed = math.ceil(remaining_cost / target_price)
-                            unit_needed = math.ceil(raw_needed / 100) * 100
-                            rem_shares = qty - unit_needed
-                            judge = f"✅ 残{rem_shares}株" if rem_shares >= 0 else "❌ 不可"
-                            sim_rows.append({
-                                "上昇率": f"+{p}%", "想定株価": f"{target_price:,.0f}円",
-                                "必要売却数": f"{unit_needed:,}株", "恩株結果": judge
-                            })
-                        st.dataframe(pd.DataFrame(sim_rows), use_container_width=True)
         else: st.info("保有なし")
     else: st.info("データなし")
 
-    st.write("")
-
-    # ▼ 💰 成功報酬管理
-    st.subheader("💰 成功報酬管理")
-    
-    df_calc = pd.DataFrame(st.session_state.trade_log) if st.session_state.trade_log else pd.DataFrame(columns=['確定損益', 'ボーナス'])
-    if 'ボーナス' not in df_calc.columns: df_calc['ボーナス'] = False
-    
-    total_pl = df_calc[df_calc['ボーナス'] == False]['確定損益'].sum()
-    bonus_base_profit = df_calc[df_calc['ボーナス'] == True]['確定損益'].sum()
-    
-    real_status = total_pl + total_onkabu_value
+@st.fragment
+def simulator_section():
+    valued = st.session_state.get('valuation', {}).get('valued')
+    if valued is None or valued.empty: return
+    port_options = {code: f"{name} ({code})" for code, name in valued['name'].items()}
+
+    with st.expander("📈 恩株シミュレーター（将来予測）", expanded=False):
+        st.info("上昇率ごとの「恩株化に必要な売却数」を全保有銘柄まとめて計算します。上昇率と売買単位は自由に変えられます。")
+        g1, g2 = st.columns([3, 1])
+        with g1: rates_text = st.text_input("上昇率 (%・カンマ区切り)", ", ".join(map(str, DEFAULT_RATES)), key="sim_rates")
+        with g2: lots = st.multiselect("売買単位 (株)", [1, 10, 100, 1000], default=[100], key="sim_lots") or [100]
+        rates = parse_rates(rates_text)
+        grid = onkabu_grid(valued, rates, lots)
+        remaining = valued['avg_price'] * valued['qty'] - valued['realized_pl']
+
+        view = st.radio("表示", ["銘柄別", "全銘柄まとめて"], horizontal=True, key="sim_view", label_visibility="collapsed")
+        if view == "銘柄別":
+            selected_code_display = st.selectbox("銘柄選択", list(port_options.values()))
+            if selected_code_display:
+                selected_code = selected_code_display.split("(")[-1].replace(")", "").strip()
+                avg, qty = valued.at[selected_code, 'avg_price'], int(valued.at[selected_code, 'qty'])
+                if remaining[selected_code] <= 0: st.success("🎉 すでに恩株化達成済みです！")
+                else:
+                    sim = pd.DataFrame({"上昇率": [f"{p:+g}%" for p in rates], "想定株価": [f"{avg * (1 + p/100):,.0f}円" for p in rates]})
+                    for lot in lots:
+                        suffix = f" ({lot}株単位)" if len(lots) > 1 else ""
+                        needed = grid.loc[selected_code, lot].to_numpy()
+                        sim["必要売却数" + suffix] = [f"{n:,}株" if n >= 0 else "---" for n in needed]
+                        sim["恩株結果" + suffix] = [f"✅ 残{qty - n}株" if 0 <= n <= qty else "❌ 不可" for n in needed]
+                    st.dataframe(sim, use_container_width=True)
+        else:
+            # 行: 銘柄、列: 上昇率 (売買単位が複数なら単位ごと)
+            labels = [f"{rate:+g}%" + (f" ({lot}株単位)" if len(lots) > 1 else "") for lot, rate in grid.columns]
+            table = pd.DataFrame(needed_labels(grid.to_numpy(), valued['qty'], remaining), index=list(port_options.values()), columns=labels)
+            st.dataframe(table, use_container_width=True)
+
+        # ▼ シナリオ（全体の値動き・銘柄ごとの目標株価）
+        st.markdown("##### 🔮 シナリオ試算")
+        s1, s2 = st.columns([1, 1])
+        with s1: move = st.number_input("全体の値動き (%)", value=0.0, step=5.0, format="%.1f", key="sim_move")
+        with s2: lot = st.selectbox("売買単位 (株)", lots, key="sim_scenario_lot")
+        targets_df = st.data_editor(
+            pd.DataFrame({"銘柄": list(port_options.values()), "現在値": valued['price'].to_numpy(), "目標株価": float("nan")}, index=valued.index),
+            key="sim_targets", hide_index=True, use_container_width=True,
+            column_config={
+                "銘柄": st.column_config.TextColumn("銘柄", disabled=True),
+                "現在値": st.column_config.NumberColumn("現在値", format="%d円", disabled=True),
+                "目標株価": st.column_config.NumberColumn("目標株価 (空欄なら全体の値動き)", min_value=0.0, format="%d円"),
+            },
+        )
+        targets = targets_df['目標株価'].dropna().to_dict()
+        result = scenario(valued, move, targets, lot)
+        now_value = (valued['price'] * valued['qty']).sum()
+        m1, m2, m3 = st.columns(3)
+        m1.metric("評価額合計", f"¥{int(result['market_value'].sum()):,}", f"{int(result['market_value'].sum() - now_value):,}")
+        m2.metric("含み損益合計", f"¥{int(result['unrealized_pl'].sum()):,}")
+        m3.metric("恩株化できる銘柄", f"{int(result['onkabu'].sum())} / {len(result)}")
+        st.dataframe(pd.DataFrame({
+            "銘柄": list(port_options.values()),
+            "想定株価": result['price'].map('{:,.0f}円'.format).to_numpy(),
+            "評価額": result['market_value'].map('{:,.0f}円'.format).to_numpy(),
+            "含み損益": result['unrealized_pl'].map('{:+,.0f}円'.format).to_numpy(),
+            "恩株化に必要な売却数": needed_labels(result['sell_needed'].to_numpy(), result['qty'], remaining)[:, 0],
+        }), use_container_width=True, hide_index=True)
+
+@st.fragment
+def fee_section():
+    valued = st.session_state.get('valuation', {}).get('valued')
+    fees = fee_summary(st.session_state.trade_log, valued['onkabu_value'].sum() if valued is not None else 0)
+    total_pl, bonus_base_profit, real_status = fees['total_pl'], fees['bonus_base_profit'], fees['real_status']
     
     col_r1, col_r2, col_r3 = st.columns([1, 1, 1])
     
@@ -517,7 +817,7 @@ def main():
 
     with col_r2:
         if total_pl > 0:
-            reward = total_pl * 0.15
+            reward = fees['reward']
             bg_color = "#d4edda" if reward > 10000 else "#f8f9fa"
             title_text = "🎉 成功報酬請求額 (15%)" if reward > 10000 else "成功報酬 (1万円以下)"
             st.markdown(f"""
@@ -538,7 +838,7 @@ def main():
 
     with col_r3:
         if bonus_base_profit > 0:
-            bonus_reward = bonus_base_profit * 0.15
+            bonus_reward = fees['bonus_reward']
             st.markdown(f"""
             <div style="background-color: #fff3cd; padding: 20px; border-radius: 10px; border: 2px solid #ffeeba;">
                 <h3 style="color: #856404; margin:0;">🏆 恩株ボーナス (15%)</h3>
@@ -560,106 +860,154 @@ def main():
 
     with st.expander("📜 過去の報酬支払履歴"):
         if st.session_state.trade_log:
-            pay_logs = [row for row in st.session_state.trade_log if row['証券コード'] == 'PAYMENT']
+            pay_logs = [t for t in st.session_state.trade_log if t.code == 'PAYMENT']
             if pay_logs:
                 pay_data = []
                 for p in pay_logs:
-                    profit_cleared = abs(p['確定損益'])
+                    profit_cleared = abs(p.pl) / 100
                     paid_amount = profit_cleared * 0.15
-                    pay_type = "🏆 恩株ボーナス" if p.get('ボーナス') else "🎉 通常成功報酬"
+                    pay_type = "🏆 恩株ボーナス" if p.bonus else "🎉 通常成功報酬"
                     pay_data.append({
-                        "支払日": p['日付'], "種類": pay_type,
+                        "支払日": p.date, "種類": pay_type,
                         "対象利益": f"¥ {int(profit_cleared):,}", "支払報酬額(15%)": f"¥ {int(paid_amount):,}"
                     })
                 st.dataframe(pd.DataFrame(pay_data), use_container_width=True)
             else: st.info("支払履歴はありません")
         else: st.info("データなし")
 
-    st.write("")
-
-    with st.expander("🗄️ 過去データ詳細（参照用）"):
-        past_df = load_csv_from_github('past_data.csv')
-        if not isinstance(past_df, list) and not past_df.empty:
-            def highlight_past_data(row):
-                if '取引形態' in row and pd.notnull(row['取引形態']):
-                    val = str(row['取引形態'])
-                    if '利確' in val: return ['background-color: #ffe6e6; color: black'] * len(row)
-                    elif '損切' in val: return ['background-color: #e6f2ff; color: black'] * len(row)
-                if '損益' in row and pd.notnull(row['損益']):
-                    try:
-                        pl = float(row['損益'])
-                        if pl > 0: return ['background-color: #ffe6e6; color: black'] * len(row)
-                        elif pl < 0: return ['background-color: #e6f2ff; color: black'] * len(row)
-                    except: pass
-                return [''] * len(row)
-
-            st.dataframe(past_df.style.apply(highlight_past_data, axis=1), use_container_width=True)
-        else:
-            st.info("past_data.csv が見つかりません。")
-
-    st.markdown("---")
-
-    st.subheader("📜 全取引履歴 (銘柄別アーカイブ)")
-    
+    rerun_app_if_changed()
+
+@st.fragment
+def history_section():
+    # 開いたときだけ日次の終値を (足りない期間だけ) 取得して、損益の推移を描く
+    exp = st.expander("📈 損益推移（日次）", key="history_open", on_change="rerun")
+    if not exp.open: return
+    with exp:
+        trades = st.session_state.trade_log
+        if not trades:
+            st.info("データなし")
+            return
+        events = get_position_events(frame_hash(trades_frame(trades)), trades)
+        with st.spinner("📈 株価履歴を取得中..."):
+            closes = get_price_history().get(events['code'].unique(), min(events['date']))
+        series = mark_to_market(events, closes)
+        chart = series[['realized', 'unrealized', 'real_status', 'fee_liability']].rename(columns={
+            'realized': "確定損益", 'unrealized': "含み損益", 'real_status': "実質損益 (恩株込)", 'fee_liability': "成功報酬見込み"})
+        st.line_chart(chart)
+        last = series.iloc[-1]
+        c1, c2, c3 = st.columns(3)
+        c1.metric("評価額", f"¥{int(last['market_value']):,}")
+        c2.metric("含み損益", f"¥{int(last['unrealized']):,}")
+        c3.metric("成功報酬見込み", f"¥{int(last['fee_liability']):,}")
+
+@st.fragment
+def archive_section():
     if st.session_state.trade_log:
-        df_log = pd.DataFrame(st.session_state.trade_log)
-        df_log['日付'] = pd.to_datetime(df_log['日付']).dt.date
-        df_log = df_log.sort_values('日付')
-
-        unique_codes = df_log['証券コード'].unique()
-        for c in unique_codes:
-            sub_df = df_log[df_log['証券コード'] == c]
-            if c == "ADJUST":
-                name_disp = "⚙️ 過去損益調整"
-                sub_pl = sub_df['確定損益'].sum()
-                label = f"{name_disp} | 調整額: ¥{int(sub_pl):,}"
-            elif c == "PAYMENT": continue 
-            else:
-                name_disp = sub_df.iloc[0]['銘柄名']
-                sub_pl = sub_df['確定損益'].sum()
-                if sub_pl > 0: label = f"🟥 {name_disp} ({c}) | 累計利益: +¥{int(sub_pl):,}"
-                elif sub_pl < 0: label = f"🟦 {name_disp} ({c}) | 累計損失: ¥{int(sub_pl):,}"
-                else: label = f"📁 {name_disp} ({c}) | 累計損益: ¥0"
-
-            with st.expander(label):
-                if c != "ADJUST":
+        df_log = trades_frame(st.session_state.trade_log).sort_values('日付', kind='stable')
+
+        index = get_archive_index(frame_hash(df_log), df_log)
+        f1, f2, f3 = st.columns([2, 1, 1])
+        with f1: query = st.text_input("🔍 銘柄名・コードで検索", key="archive_query")
+        with f2: kind = st.selectbox("絞り込み", ["すべて", "利益", "損失"], key="archive_kind")
+        with f3: size = st.selectbox("表示件数", [10, 20, 50], key="archive_size")
+        entries = filter_archive(index, query, kind)
+        start, stop = pager("archive_page", len(entries), size)
+
+        # グラフと表は開いている銘柄の分だけ作る
+        for entry in entries[start:stop]:
+            exp = st.expander(entry['label'], key=f"archive_{entry['code']}", on_change="rerun")
+            if not exp.open: continue
+            with exp:
+                if entry['code'] != "ADJUST":
                     st.caption("📊 損益推移グラフ")
-                    chart_df = sub_df[sub_df['確定損益'] != 0].copy()
-                    if not chart_df.empty:
-                        st.bar_chart(chart_df.set_index('日付')['確定損益'], color="#FF4B4B")
+                    if not entry['chart'].empty:
+                        st.bar_chart(entry['chart'], color="#FF4B4B")
                     else:
                         st.caption("※決済データがまだありません")
 
-                st.dataframe(
-                    sub_df[['日付','区分','数量','約定単価','確定損益','ボーナス']].sort_values('日付', ascending=False),
-                    use_container_width=True, hide_index=True
-                )
+                st.dataframe(entry['table'], use_container_width=True, hide_index=True)
 
         st.write("")
         
         if IS_ADMIN:
-            with st.expander("🛠️ データの修正・削除（管理者のみ）", expanded=False):
-                if "削除" not in df_log.columns: df_log.insert(0, "削除", False)
-                if "ボーナス" not in df_log.columns: df_log["ボーナス"] = False
-                
-                edited_df = st.data_editor(
-                    df_log.sort_values('日付', ascending=False),
-                    num_rows="dynamic",
-                    use_container_width=True, hide_index=True,
-                    column_config={
-                        "削除": st.column_config.CheckboxColumn("削除", width="small"),
-                        "ボーナス": st.column_config.CheckboxColumn("🎉恩株", width="small", help="恩株化（元本全回収）の取引だった場合はチェック"),
-                        "日付": st.column_config.DateColumn("日付", format="YYYY-MM-DD"),
-                        "数量": st.column_config.NumberColumn("数量", min_value=0),
-                        "約定単価": st.column_config.NumberColumn("約定単価", format="%d円"),
-                        "平均単価": st.column_config.NumberColumn("平均単価", disabled=True),
-                        "確定損益": st.column_config.NumberColumn("確定損益", disabled=True),
-                    }
-                )
-                if st.button("💾 修正・削除を反映", type="secondary"):
-                    handle_save_changes(edited_df)
+            editor = st.expander("🛠️ データの修正・削除（管理者のみ）", key="log_editor_open", on_change="rerun")
+            if editor.open:
+                with editor:
+                    if "削除" not in df_log.columns: df_log.insert(0, "削除", False)
+                    if "ボーナス" not in df_log.columns: df_log["ボーナス"] = False
+
+                    # 表示中の範囲 (検索結果の1ページ分) だけを編集・保存する
+                    e1, e2 = st.columns([3, 1])
+                    with e1: edit_query = st.text_input("🔍 銘柄名・コードで検索", key="editor_query")
+                    with e2: edit_size = st.selectbox("表示件数", [50, 100, 200], key="editor_size")
+                    matched = filter_log(df_log, edit_query).sort_values('日付', ascending=False)
+                    start, stop = pager("editor_page", len(matched), edit_size)
+                    editor_df = matched.iloc[start:stop]
+                    edited_df = st.data_editor(
+                        editor_df,
+                        key=f"log_editor_{edit_query}_{edit_size}_{start}",
+                        num_rows="dynamic",
+                        use_container_width=True, hide_index=True,
+                        column_config={
+                            "削除": st.column_config.CheckboxColumn("削除", width="small"),
+                            "ボーナス": st.column_config.CheckboxColumn("🎉恩株", width="small", help="恩株化（元本全回収）の取引だった場合はチェック"),
+                            "日付": st.column_config.DateColumn("日付", format="YYYY-MM-DD"),
+                            "数量": st.column_config.NumberColumn("数量", min_value=0),
+                            "約定単価": st.column_config.NumberColumn("約定単価", format="%d円"),
+                            "平均単価": st.column_config.NumberColumn("平均単価", disabled=True),
+                            "確定損益": st.column_config.NumberColumn("確定損益", disabled=True),
+                        }
+                    )
+                    if st.button("💾 修正・削除を反映", type="secondary"):
+                        handle_save_changes(edited_df, editor_df)
     else:
         st.info("履歴なし")
 
+
+def show_diagnostics():
+    with st.expander("🩺 診断情報（管理者のみ）", expanded=False):
+        client = get_github_client()
+        if client:
+            rate = client.rate_limit()
+            if rate["remaining"] < 0:
+                st.caption("GitHub API: まだ呼び出していません")
+            else:
+                reset = datetime.fromtimestamp(rate["reset"]).strftime('%H:%M:%S')
+                c1, c2, c3 = st.columns(3)
+                c1.metric("GitHub API 残り回数", f"{rate['remaining']:,} / {rate['limit']:,}")
+                c2.metric("リセット時刻", reset)
+                c3.metric("待機した回数", client.throttled)
+        else:
+            st.caption("GitHub API: 未設定")
+        pending = getattr(get_storage(), "pending", None)
+        if pending: st.caption(f"未送信のファイル: {', '.join(pending()) or 'なし'}")
+
+        # ▼ 保存形式 (読み込みは Arrow が優先。CSV を手で直したときはここから作り直す)
+        st.markdown("##### 🗄️ 保存形式")
+        st.caption(f"{TRADE_TABLE} / {PAST_TABLE} を優先して読み込みます。trade_log.csv・past_data.csv を直接編集したときは作り直してください。")
+        if st.button("CSV から Arrow を作り直す", key="rebuild_tables") and rebuild_tables():
+            st.rerun()
+
+        # ▼ 処理時間（前回の再実行の内訳と、直近の p50/p95/p99）
+        st.markdown("##### ⏱️ 処理時間")
+        if 'first_paint' in st.session_state:
+            st.caption(f"このセッションの初回表示: {st.session_state.first_paint:,.0f} ms (p50/p95 は下の first_paint)")
+        last_run = st.session_state.get('last_run')
+        if last_run:
+            st.caption("前回の再実行")
+            st.dataframe(pd.DataFrame(last_run, columns=['処理', 'ミリ秒']), use_container_width=True, hide_index=True,
+                         column_config={"ミリ秒": st.column_config.NumberColumn(format="%.1f")})
+        rows = perf.percentiles()
+        if rows:
+            st.caption("直近の分布 (ミリ秒)")
+            st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True,
+                         column_config={c: st.column_config.NumberColumn(format="%.1f") for c in ['p50', 'p95', 'p99']})
+        counts = perf.counters()
+        if counts:
+            st.caption("カウンタ")
+            st.dataframe(pd.Series(counts, name="回数").sort_index(), use_container_width=True)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with perf.run() as spans:
+        main()
+    st.session_state.last_run = spans
\ No newline at end of file
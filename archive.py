@@ -0,0 +1,64 @@
+import hashlib
+
+import pandas as pd
+
+# --- 銘柄別アーカイブ ---
+# 取引履歴を銘柄ごとに1回の groupby でまとめ、見出し・累計損益・決済グラフ・履歴表を作る
+
+ARCHIVE_COLUMNS = ['日付', '区分', '数量', '約定単価', '確定損益', 'ボーナス']
+
+
+def frame_hash(df):
+    # 取引履歴の内容から作るハッシュ。中身が同じなら同じ値になる
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def archive_label(code, name, pl):
+    if code == "ADJUST": return f"⚙️ 過去損益調整 | 調整額: ¥{int(pl):,}"
+    if pl > 0: return f"🟥 {name} ({code}) | 累計利益: +¥{int(pl):,}"
+    if pl < 0: return f"🟦 {name} ({code}) | 累計損失: ¥{int(pl):,}"
+    return f"📁 {name} ({code}) | 累計損益: ¥0"
+
+
+def archive_index(df_log):
+    # 最初に取引した順の銘柄一覧。報酬精算 (PAYMENT) は含めない
+    df = df_log.sort_values('日付', kind='stable')
+    df = df[df['証券コード'] != "PAYMENT"]
+    groups = df.groupby('証券コード', sort=False)
+    pl = groups['確定損益'].sum()
+    names = df.drop_duplicates('証券コード').set_index('証券コード')['銘柄名']
+
+    index = []
+    for code, sub in groups:
+        realized = sub[sub['確定損益'] != 0]
+        index.append({
+            'code': code, 'name': names[code], 'pl': pl[code],
+            'label': archive_label(code, names[code], pl[code]),
+            'chart': realized.set_index('日付')['確定損益'],
+            'table': sub[ARCHIVE_COLUMNS].iloc[::-1],
+        })
+    return index
+
+
+def filter_archive(index, query="", kind="すべて"):
+    # 銘柄名・コードの部分一致と、利益/損失での絞り込み
+    query = query.strip().lower()
+    if query: index = [e for e in index if query in e['code'].lower() or query in str(e['name']).lower()]
+    if kind == "利益": index = [e for e in index if e['pl'] > 0]
+    elif kind == "損失": index = [e for e in index if e['pl'] < 0]
+    return index
+
+
+def filter_log(df, query=""):
+    query = query.strip()
+    if not query: return df
+    hit = df['証券コード'].astype(str).str.contains(query, case=False, regex=False)
+    hit |= df['銘柄名'].astype(str).str.contains(query, case=False, regex=False)
+    return df[hit]
+
+
+def page_bounds(total, page, size):
+    # 1始まりのページ番号から (開始位置, 終了位置, ページ数) を返す。範囲外のページは端に寄せる
+    pages = max(1, -(-total // size))
+    page = min(max(1, page), pages)
+    return (page - 1) * size, min(page * size, total), pages
@@ -0,0 +1,145 @@
+import argparse
+import random
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import pandas as pd
+import yfinance as yf
+
+import fakes
+from columnar import read_table, trades_from_table, trades_to_arrow
+from fakes import FakeRepo
+from ledger import LOG_COLUMNS, LedgerEngine, Trade, recalculate_all, trades_from_csv
+from quotes import QuoteEngine, QuoteStore, fetch_stock_price
+from storage import GitHubStorage
+from valuation import fee_summary, format_holdings, holdings_frame, quotes_frame, value_holdings
+
+# --- ベンチマーク ---
+# 合成した取引履歴で主な処理の速さとメモリ使用量を測る。ネットワークには繋がない
+#   python bench.py --sizes 500,50000,1000000 --codes 200 --quote-latency 0.05
+
+
+def synthetic_logs(n, codes=50, seed=0):
+    # 買い・売り・恩株化の売り・データ調整・報酬精算を混ぜた n 件の取引履歴 (日付順)
+    rng = random.Random(seed)
+    universe = [str(1300 + i * 7) for i in range(codes)]
+    held = {}
+    logs = []
+    day = date(2015, 1, 5)
+    for i in range(n):
+        if rng.random() < 0.3: day += timedelta(days=1)
+        r = rng.random()
+        if r < 0.02:
+            logs.append({'日付': day, '区分': "データ調整", '証券コード': "ADJUST", '銘柄名': "📊 過去損益調整引継",
+                         '数量': 0, '約定単価': 0, '平均単価': 0, '確定損益': rng.randint(-500000, 500000), 'ボーナス': False})
+            continue
+        if r < 0.03:
+            logs.append({'日付': day, '区分': "報酬精算", '証券コード': "PAYMENT", '銘柄名': "✅ 成功報酬精算完了",
+                         '数量': 0, '約定単価': 0, '平均単価': 0, '確定損益': -rng.randint(0, 300000), 'ボーナス': rng.random() < 0.2})
+            continue
+
+        code = rng.choice(universe)
+        price = round(rng.uniform(100, 8000), 1)
+        if held.get(code, 0) >= 100 and r < 0.45:
+            bonus = r < 0.06
+            qty = held[code] if bonus else rng.randrange(100, held[code] + 1, 100)
+            held[code] -= qty
+            logs.append({'日付': day, '区分': "売り", '証券コード': code, '銘柄名': f"Fake {code}",
+                         '数量': qty, '約定単価': price, '平均単価': 0, '確定損益': 0, 'ボーナス': bonus})
+        else:
+            qty = rng.choice([100, 100, 200, 500, 1000])
+            held[code] = held.get(code, 0) + qty
+            logs.append({'日付': day, '区分': "買い", '証券コード': code, '銘柄名': f"Fake {code}",
+                         '数量': qty, '約定単価': price, '平均単価': 0, '確定損益': 0, 'ボーナス': False})
+    return logs
+
+
+def measure(fn, memory=True):
+    # (秒, 最大メモリ MB, 戻り値)。メモリは tracemalloc を有効にした2回目の実行で測る
+    t = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def run(n, codes, quote_latency, repo_latency, memory):
+    logs = synthetic_logs(n, codes)
+    csv = pd.DataFrame(logs, columns=LOG_COLUMNS).to_csv(index=False)
+    trades = [Trade.from_log(log) for log in logs]
+    repo = FakeRepo({'trade_log.csv': csv, 'trade_log.arrow': trades_to_arrow(recalculate_all([t.copy() for t in trades])[1])}, latency=repo_latency)
+    storage = GitHubStorage(lambda: repo, check_interval=0)
+
+    def load():
+        storage._blobs.clear()
+        return trades_from_csv(storage.read('trade_log.csv'))[0]
+
+    def load_arrow():
+        storage._blobs.clear()
+        return trades_from_table(read_table(storage.read('trade_log.arrow')))[0]
+
+    portfolio = {}
+
+    def recalc():
+        nonlocal portfolio
+        portfolio, _ = recalculate_all([t.copy() for t in trades])
+
+    yf.Ticker = fakes.fake_ticker(quote_latency)
+    engine = QuoteEngine(QuoteStore(":memory:", max_entries=codes * 2), rate=1e9, burst=1e9)
+
+    def fetch_quotes():
+        # 保有銘柄の銘柄名・株価を並列に取ってキャッシュに入れる (アプリでは裏の更新スレッドが行う)
+        codes = list(holdings_frame(portfolio).index)
+        with ThreadPoolExecutor(max_workers=engine.max_workers) as pool:
+            for code, quote in zip(codes, pool.map(fetch_stock_price, codes)): engine.store.put_price(code, quote)
+        engine.get_names(codes)
+
+    def valuation():
+        holdings = holdings_frame(portfolio)
+        snapshot = engine.snapshot(holdings.index)
+        quotes = {code: info for code, (info, _) in snapshot.items()}
+        status = {code: state for code, (_, state) in snapshot.items()}
+        return format_holdings(value_holdings(holdings, quotes_frame(quotes, status)))
+
+    cases = [
+        ("CSV 読み込み", load),
+        ("Arrow 読み込み", load_arrow),
+        ("recalculate_all", recalc),
+        ("LedgerEngine 構築", lambda: LedgerEngine([t.copy() for t in trades])),
+        ("株価の取得", fetch_quotes),
+        ("評価 (キャッシュ済みの株価)", valuation),
+        ("成功報酬の集計", lambda: fee_summary(trades)),
+    ]
+    rows = []
+    for name, fn in cases:
+        elapsed, peak, _ = measure(fn, memory)
+        rows.append({'件数': n, '処理': name, '秒': elapsed, '件/秒': n / elapsed, '最大メモリMB': peak})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成した取引履歴で主要な処理を計測する")
+    parser.add_argument("--sizes", default="500,5000,50000", help="取引件数 (カンマ区切り)")
+    parser.add_argument("--codes", type=int, default=50, help="銘柄数")
+    parser.add_argument("--quote-latency", type=float, default=0.0, help="株価取得1回あたりの待ち時間 (秒)")
+    parser.add_argument("--repo-latency", type=float, default=0.0, help="GitHub API 1回あたりの待ち時間 (秒)")
+    parser.add_argument("--no-memory", action="store_true", help="メモリ計測を省略する")
+    args = parser.parse_args()
+
+    rows = []
+    for n in (int(s) for s in args.sizes.split(",")):
+        rows += run(n, args.codes, args.quote_latency, args.repo_latency, not args.no_memory)
+    df = pd.DataFrame(rows)
+    with pd.option_context('display.float_format', '{:,.3f}'.format, 'display.width', 120):
+        print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
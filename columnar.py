@@ -0,0 +1,103 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+from ledger import KINDS, LABELS, LOG_COLUMNS, Trade, skipped_rows
+
+# --- 列形式 (Arrow) での保存・読み込み ---
+# trade_log / past_data を型つきの Arrow IPC (Feather v2) ファイルとして CSV と並べて置く。
+# 圧縮しないので、読み込みはバッファ (ローカルなら memory map) を写さずにそのまま使える。
+# trade_log の金額列は銭単位の整数 (スキーマのメタデータ amount_unit = sen)
+
+EPOCH = date(1970, 1, 1)
+
+TRADE_SCHEMA = pa.schema([
+    ('日付', pa.date32()),
+    ('区分', pa.dictionary(pa.int8(), pa.string())),
+    ('証券コード', pa.dictionary(pa.int32(), pa.string())),
+    ('銘柄名', pa.dictionary(pa.int32(), pa.string())),
+    ('数量', pa.int64()),
+    ('約定単価', pa.int64()),
+    ('平均単価', pa.int64()),
+    ('確定損益', pa.int64()),
+    ('ボーナス', pa.bool_()),
+], metadata={b"amount_unit": b"sen"})
+
+
+def write_table(table):
+    sink = pa.BufferOutputStream()
+    feather.write_feather(table, sink, compression="uncompressed")
+    return sink.getvalue().to_pybytes()
+
+
+def read_table(buffer):
+    # buffer は bytes / memory map
+    return feather.read_table(pa.BufferReader(pa.py_buffer(buffer)), memory_map=False)
+
+
+def _dictionary(values, type):
+    # 同じ文字列が多い列は辞書エンコードにする (番号は初出順)
+    index = {}
+    codes = [index.setdefault(v, len(index)) for v in values]
+    return pa.DictionaryArray.from_arrays(pa.array(codes, type=type.index_type), pa.array(list(index), pa.string()))
+
+
+def trades_to_arrow(trades, metadata=None):
+    # metadata ({bytes: bytes}) はスキーマのメタデータに足す
+    columns = [
+        pa.array([t.date for t in trades], pa.date32()),
+        pa.DictionaryArray.from_arrays(pa.array([int(t.kind) for t in trades], pa.int8()), pa.array(LABELS, pa.string())),
+        _dictionary([t.code for t in trades], TRADE_SCHEMA.field('証券コード').type),
+        _dictionary([t.name for t in trades], TRADE_SCHEMA.field('銘柄名').type),
+        pa.array([t.qty for t in trades], pa.int64()),
+        pa.array([t.price for t in trades], pa.int64()),
+        pa.array([t.avg for t in trades], pa.int64()),
+        pa.array([t.pl for t in trades], pa.int64()),
+        pa.array([t.bonus for t in trades], pa.bool_()),
+    ]
+    schema = TRADE_SCHEMA.with_metadata({**TRADE_SCHEMA.metadata, **metadata}) if metadata else TRADE_SCHEMA
+    return write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+def _dates(column):
+    # date32 の列を datetime.date のリストにする。同じ日付のオブジェクトは使い回す
+    days = column.cast(pa.int32()).to_numpy()
+    unique, inverse = np.unique(days, return_inverse=True)
+    values = [EPOCH + timedelta(days=int(d)) for d in unique]
+    return [values[i] for i in inverse.tolist()]
+
+
+def _decoded(column, lookup=None):
+    # 辞書エンコードの列は辞書側だけを変換し、番号で引く
+    column = column.combine_chunks()
+    words = column.dictionary.to_pylist()
+    if lookup: words = [lookup.get(w) for w in words]
+    return [words[i] for i in column.indices.to_pylist()]
+
+
+def trades_from_table(table):
+    # (Trade のリスト, 読み込めない行の表)。区分が不明な行は飛ばし、理由をつけて別に返す
+    if table.schema.metadata.get(b"amount_unit") != b"sen": raise ValueError("trade_log の金額の単位が不明です")
+    skipped = skipped_rows([], [])
+    unknown = set(table['区分'].combine_chunks().dictionary.to_pylist()) - set(KINDS)
+    if unknown:
+        bad = pc.is_in(table['区分'].cast(pa.string()), pa.array(sorted(unknown)))
+        rows = table.filter(bad).to_pandas()
+        for c in ('約定単価', '平均単価', '確定損益'): rows[c] = rows[c] / 100
+        skipped = skipped_rows(rows, "区分が不明です")
+        table = table.filter(pc.invert(bad))
+    columns = [
+        _dates(table['日付']),
+        _decoded(table['区分'], KINDS),
+        _decoded(table['証券コード']),
+        _decoded(table['銘柄名']),
+        *(table[c].to_pylist() for c in LOG_COLUMNS[4:]),
+    ]
+    return [Trade(*row) for row in zip(*columns)], skipped
+
+
+def frame_to_arrow(df):
+    return write_table(pa.Table.from_pandas(df, preserve_index=False))
@@ -0,0 +1,190 @@
+import base64
+import hashlib
+import json
+import os
+import time
+import types
+from urllib.parse import unquote
+
+import pandas as pd
+from github import GithubException, UnknownObjectException
+
+# --- オフライン用の代役 ---
+# PyGithub の Repository と yfinance の Ticker のうち、このアプリが使う部分だけを真似たもの。
+# GitHub や Yahoo に繋がない環境で保存・読み込みの動きを確かめたり、ベンチマークを取るために使う。
+# latency を指定すると API 呼び出しごとにその秒数だけ待つ
+
+
+def _sha(kind, data):
+    return hashlib.sha1(f"{kind} {len(data)}\0".encode() + data).hexdigest()
+
+
+class FakeRepo:
+    def __init__(self, files=None, branch="main", latency=0.0):
+        self.default_branch = branch
+        self.latency = latency
+        self.full_name = "local/fake"
+        self.url = "https://api.github.com/repos/local/fake"
+        self.requester = _FakeRequester(self)
+        self.calls = []
+        self._blobs = {}
+        self._trees = {}
+        self._commits = {}
+        self._refs = {}
+
+        tree = {path: self._put_blob(data.encode() if isinstance(data, str) else data) for path, data in (files or {}).items()}
+        tree_sha = self._put_tree(tree)
+        commit = self._put_commit("initial", tree_sha, [])
+        self._refs[f"heads/{branch}"] = commit
+
+    @classmethod
+    def from_dir(cls, path, names=None, latency=0.0):
+        names = names or [n for n in os.listdir(path) if n.endswith((".csv", ".arrow"))]
+        files = {}
+        for name in names:
+            with open(os.path.join(path, name), "rb") as f:
+                files[name] = f.read()
+        return cls(files, latency=latency)
+
+    def _call(self, *call):
+        self.calls.append(call)
+        if self.latency: time.sleep(self.latency)
+
+    # --- 内部のオブジェクト保存 ---
+
+    def _put_blob(self, data):
+        sha = _sha("blob", data)
+        self._blobs[sha] = data
+        return sha
+
+    def _put_tree(self, entries):
+        sha = _sha("tree", repr(sorted(entries.items())).encode())
+        self._trees[sha] = dict(entries)
+        return sha
+
+    def _put_commit(self, message, tree_sha, parents):
+        sha = _sha("commit", repr((message, tree_sha, parents, len(self._commits))).encode())
+        self._commits[sha] = (tree_sha, parents, message)
+        return sha
+
+    def _tree_obj(self, sha):
+        entries = [types.SimpleNamespace(path=p, sha=s, type="blob") for p, s in sorted(self._trees[sha].items())]
+        return types.SimpleNamespace(sha=sha, tree=entries)
+
+    def _commit_obj(self, sha):
+        tree_sha, parents, message = self._commits[sha]
+        return types.SimpleNamespace(sha=sha, tree=self._tree_obj(tree_sha), parents=parents, message=message)
+
+    def head_files(self):
+        tree_sha = self._commits[self._refs[f"heads/{self.default_branch}"]][0]
+        return {path: self._blobs[sha] for path, sha in self._trees[tree_sha].items()}
+
+    # --- PyGithub 互換の API ---
+
+    def get_contents(self, path):
+        self._call("get_contents", path)
+        tree_sha = self._commits[self._refs[f"heads/{self.default_branch}"]][0]
+        sha = self._trees[tree_sha].get(path)
+        if sha is None: raise UnknownObjectException(404, {"message": "Not Found"}, None)
+        return types.SimpleNamespace(path=path, sha=sha, decoded_content=self._blobs[sha])
+
+    def get_git_blob(self, sha):
+        self._call("get_git_blob", sha)
+        return types.SimpleNamespace(sha=sha, encoding="base64", content=base64.b64encode(self._blobs[sha]).decode("ascii"))
+
+    def get_git_ref(self, ref):
+        self._call("get_git_ref", ref)
+        if ref not in self._refs: raise UnknownObjectException(404, {"message": "Not Found"}, None)
+        return _FakeRef(self, ref)
+
+    def get_git_commit(self, sha):
+        self._call("get_git_commit", sha)
+        return self._commit_obj(sha)
+
+    def create_git_blob(self, content, encoding):
+        self._call("create_git_blob", encoding)
+        data = base64.b64decode(content) if encoding == "base64" else content.encode()
+        return types.SimpleNamespace(sha=self._put_blob(data))
+
+    def create_git_tree(self, tree, base_tree=None):
+        self._call("create_git_tree", len(tree))
+        entries = dict(self._trees[base_tree.sha]) if base_tree is not None else {}
+        for element in tree:
+            e = element._identity
+            if "content" in e: entries[e["path"]] = self._put_blob(e["content"].encode())
+            elif e.get("sha") is None: entries.pop(e["path"], None)
+            else: entries[e["path"]] = e["sha"]
+        return self._tree_obj(self._put_tree(entries))
+
+    def create_git_commit(self, message, tree, parents):
+        self._call("create_git_commit", message)
+        return self._commit_obj(self._put_commit(message, tree.sha, [p.sha for p in parents]))
+
+
+class _FakeRef:
+    def __init__(self, repo, ref):
+        self._repo = repo
+        self.ref = f"refs/{ref}"
+        self._name = ref
+        self.object = types.SimpleNamespace(sha=repo._refs[ref])
+
+    def edit(self, sha, force=False):
+        repo = self._repo
+        repo._call("edit_ref", sha)
+        current = repo._refs[self._name]
+        if not force and current not in repo._commits[sha][1]:
+            raise GithubException(422, {"message": "Update is not a fast forward"}, None)
+        repo._refs[self._name] = sha
+        self.object = types.SimpleNamespace(sha=sha)
+
+
+class _FakeRequester:
+    # contents API への条件付き GET (If-None-Match) だけを真似る
+    def __init__(self, repo):
+        self._repo = repo
+
+    def requestJson(self, verb, url, parameters=None, headers=None, input=None, cnx=None, follow_302_redirect=False):
+        repo = self._repo
+        path = unquote(url.split("/contents/", 1)[1])
+        repo._call("requestJson", verb, path)
+        tree_sha = repo._commits[repo._refs[f"heads/{repo.default_branch}"]][0]
+        sha = repo._trees[tree_sha].get(path)
+        if sha is None: return 404, {}, json.dumps({"message": "Not Found"})
+        etag = f'"{sha}"'
+        if (headers or {}).get("If-None-Match") == etag: return 304, {"etag": etag}, ""
+        body = {"path": path, "sha": sha, "encoding": "base64", "content": base64.b64encode(repo._blobs[sha]).decode("ascii")}
+        return 200, {"etag": etag}, json.dumps(body)
+
+
+class FakeTicker:
+    # yf.Ticker の代わり。株価はコードから決まる値、銘柄名は "Fake <コード>"
+    latency = 0.0
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        code = symbol.split(".")[0]
+        seed = int(hashlib.sha1(code.encode()).hexdigest()[:8], 16)
+        self._price = float(500 + seed % 5000)
+        self._prev = self._price * (1 + ((seed >> 8) % 200 - 100) / 2000)
+
+    def _wait(self):
+        if self.latency: time.sleep(self.latency)
+
+    @property
+    def info(self):
+        self._wait()
+        return {"longName": f"Fake {self.symbol.split('.')[0]}"}
+
+    @property
+    def fast_info(self):
+        self._wait()
+        return types.SimpleNamespace(last_price=self._price, previous_close=self._prev)
+
+    def history(self, period="1d", **kwargs):
+        self._wait()
+        return pd.DataFrame({"Close": [self._price]})
+
+
+def fake_ticker(latency=0.0):
+    # 待ち時間つきの FakeTicker クラスを作る (yf.Ticker に差し替えて使う)
+    return type("FakeTicker", (FakeTicker,), {"latency": latency})
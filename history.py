@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ledger import apply_trade
+from quotes import SYSTEM_CODES
+from valuation import FEE_RATE
+
+# --- 損益推移 (日次の時価評価) ---
+
+
+class PriceHistory:
+    # 日次終値のキャッシュ。列 = 銘柄コード、行 = 日付の表を Parquet に保存し、
+    # 銘柄ごとに取得済みの期間を覚えておいて、足りない期間だけをまとめてダウンロードする。
+    # 確定していない当日分は ttl 秒ごとにだけ取り直す
+    def __init__(self, path, download=None, ttl=300):
+        self.path = path
+        self.download = download
+        self.ttl = ttl
+        self._recent = {}
+        self._lock = threading.Lock()
+        self.closes, self.ranges = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path): return pd.DataFrame(dtype=float), {}
+        try:
+            table = pq.read_table(self.path)
+            ranges = json.loads((table.schema.metadata or {}).get(b"ranges", b"{}"))
+            closes = table.to_pandas().set_index("date")
+            closes.index = pd.to_datetime(closes.index)
+            return closes, {c: (date.fromisoformat(s), date.fromisoformat(e)) for c, (s, e) in ranges.items()}
+        except Exception:
+            return pd.DataFrame(dtype=float), {}
+
+    def _save(self):
+        if os.path.dirname(self.path): os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        df = self.closes.copy()
+        df.index.name = "date"
+        table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+        ranges = {c: (s.isoformat(), e.isoformat()) for c, (s, e) in self.ranges.items()}
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"ranges": json.dumps(ranges).encode()})
+        tmp = self.path + ".tmp"
+        pq.write_table(table, tmp)
+        os.replace(tmp, self.path)
+
+    def _missing(self, code, start, end, settled):
+        have = self.ranges.get(code)
+        if not have: return [(start, end)]
+        gaps = []
+        if start < have[0]: gaps.append((start, have[0] - timedelta(days=1)))
+        if end > have[1]:
+            unsettled_only = have[1] >= settled
+            if not (unsettled_only and time.monotonic() - self._recent.get(code, -self.ttl) < self.ttl):
+                gaps.append((have[1] + timedelta(days=1), end))
+        return gaps
+
+    def _fetch(self, codes, start, end):
+        # 同じ期間が足りない銘柄は1回の一括ダウンロードで取る
+        tickers = [f"{c}.T" for c in codes]
+        if self.download is None:
+            import yfinance as yf
+            self.download = yf.download
+        try:
+            raw = self.download(tickers, start=start.isoformat(), end=(end + timedelta(days=1)).isoformat(),
+                                interval="1d", auto_adjust=False, progress=False, group_by="column", threads=True)
+        except Exception:
+            return None
+        # 空の結果は一時的な失敗・回数制限のことが多いので、取れなかったものとして扱う
+        if raw is None or raw.empty or "Close" not in raw: return None
+        close = raw["Close"]
+        if isinstance(close, pd.Series): close = close.to_frame(tickers[0])
+        close = close.rename(columns=lambda t: str(t).removesuffix(".T"))
+        close.index = pd.to_datetime(close.index).tz_localize(None).normalize()
+        return close.dropna(axis=1, how="all")
+
+    def get(self, codes, start, end=None):
+        # start〜end の日次終値 (列 = codes)。取得できなかった日・銘柄は NaN
+        end = end or date.today()
+        settled = min(end, date.today() - timedelta(days=1))
+        codes = [c for c in dict.fromkeys(str(c).strip() for c in codes) if c not in SYSTEM_CODES]
+        with self._lock:
+            wanted = {}
+            for code in codes:
+                for gap in self._missing(code, start, end, settled):
+                    wanted.setdefault(gap, []).append(code)
+
+            changed = False
+            for (gap_start, gap_end), group in wanted.items():
+                fetched = self._fetch(group, gap_start, gap_end)
+                if fetched is None or fetched.empty: continue
+                self.closes = fetched.combine_first(self.closes) if not self.closes.empty else fetched
+                # 終値が1つも返らなかった銘柄は取得済みにしない (次の呼び出しで取り直す)
+                for code in (c for c in group if c in fetched.columns):
+                    self._recent[code] = time.monotonic()
+                    have = self.ranges.get(code, (gap_start, min(gap_end, settled)))
+                    self.ranges[code] = (min(have[0], gap_start), max(have[1], min(gap_end, settled)))
+                changed = True
+            if changed:
+                self.closes = self.closes.sort_index()
+                self._save()
+
+            window = self.closes.loc[pd.Timestamp(start):pd.Timestamp(end)]
+            return window.reindex(columns=codes)
+
+
+def position_events(trades):
+    # 取引を日付順に適用し、取引ごとに (日付, 銘柄, 保有数, 平均単価, 確定損益, 恩株フラグ) を記録する
+    positions = {}
+    rows = []
+    for trade in sorted((t.copy() for t in trades), key=lambda t: t.date):
+        apply_trade(positions, trade)
+        if not trade.kind.is_trade:
+            rows.append((trade.date, trade.code, np.nan, np.nan, trade.pl / 100, trade.bonus))
+        else:
+            cur = positions.get(trade.code)
+            rows.append((trade.date, trade.code, cur.qty if cur else 0, cur.avg / 100 if cur else 0.0, trade.pl / 100, trade.bonus))
+    return pd.DataFrame(rows, columns=['date', 'code', 'qty', 'avg_price', 'pl', 'bonus'])
+
+
+def mark_to_market(events, closes, end=None, fee_rate=FEE_RATE):
+    # 日次の 確定損益 (通常 / 恩株)・含み損益・恩株の評価額・成功報酬の見込み額
+    if events.empty: return pd.DataFrame()
+    events = events.assign(date=pd.to_datetime(events['date']))
+    days = pd.bdate_range(events['date'].min(), pd.Timestamp(end or date.today()))
+    days = days.union(pd.DatetimeIndex(events['date'].unique()))
+
+    pl = events.pivot_table(index='date', columns='bonus', values='pl', aggfunc='sum').reindex(days).fillna(0).cumsum()
+    realized = pl[False] if False in pl else pd.Series(0.0, index=days)
+    bonus = pl[True] if True in pl else pd.Series(0.0, index=days)
+
+    trades = events.dropna(subset=['qty']).drop_duplicates(['date', 'code'], keep='last')
+    qty = trades.pivot(index='date', columns='code', values='qty').reindex(days).ffill().fillna(0)
+    avg = trades.pivot(index='date', columns='code', values='avg_price').reindex(days).ffill().fillna(0)
+    price = closes.reindex(columns=qty.columns).reindex(days.union(closes.index)).ffill().reindex(days)
+
+    held = price.notna() & (qty > 0)
+    unrealized = ((price - avg) * qty).where(held, 0).sum(axis=1)
+    onkabu = (price * qty).where(held & (avg == 0), 0).sum(axis=1)
+    market = (price * qty).where(held, 0).sum(axis=1)
+
+    return pd.DataFrame({
+        'realized': realized,
+        'bonus_realized': bonus,
+        'unrealized': unrealized,
+        'onkabu_value': onkabu,
+        'market_value': market,
+        'real_status': realized + onkabu,
+        'equity': realized + bonus + unrealized,
+        'fee_liability': realized.clip(lower=0) * fee_rate + bonus.clip(lower=0) * fee_rate,
+    }, index=days)
@@ -0,0 +1,111 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from ledger import BUY_TYPES, LOG_COLUMNS, NON_TRADE_TYPES, SELL_TYPES, trades_from_frame
+
+# --- CSV の一括取り込み ---
+# trade_log.csv と同じ列の CSV か、past_data.csv と同じ列の CSV を読み、Trade のリストにする。
+# 検査・変換は列単位でまとめて行い、問題のある行は理由つきで別に返す
+
+TRADE_LAYOUT = ['日付', '区分', '証券コード', '数量', '約定単価']
+PAST_LAYOUT = ['日付', '証券コード', '損益']
+
+
+def read_import(data):
+    return pd.read_csv(io.BytesIO(data), encoding="utf-8-sig", dtype=str, keep_default_na=False)
+
+
+def parse_dates(col):
+    # "2024" のように年だけの日付はその年の1月1日にする
+    s = col.astype(str).str.strip().str.replace("/", "-", regex=False)
+    s = s.where(~s.str.fullmatch(r"\d{4}"), s + "-01-01")
+    return pd.to_datetime(s, errors="coerce", format="ISO8601").dt.date
+
+
+def parse_numbers(col):
+    return pd.to_numeric(col.astype(str).str.replace(",", "", regex=False).str.replace("円", "", regex=False).str.strip(), errors="coerce")
+
+
+def parse_codes(col):
+    return col.astype(str).str.strip().str.removesuffix(".0").str.removesuffix(".T")
+
+
+def _flags(col):
+    return col.astype(str).str.strip().str.lower().isin(["true", "1", "yes", "○", "✓"])
+
+
+def normalize_import(df):
+    # (Trade のリスト, 取り込めない行の表) を返す。列の並びから形式を判断する
+    if all(c in df.columns for c in TRADE_LAYOUT): return _normalize_trades(df)
+    if all(c in df.columns for c in PAST_LAYOUT): return _normalize_past(df)
+    missing = [c for c in TRADE_LAYOUT if c not in df.columns]
+    raise ValueError(f"列が足りません: {', '.join(missing)}（trade_log.csv か past_data.csv と同じ列にしてください）")
+
+
+def _split(out, problems, source):
+    # problems: 行ごとの理由 (問題がなければ空文字)
+    bad = problems != ""
+    errors = source[bad].assign(理由=problems[bad])
+    return trades_from_frame(out[~bad][LOG_COLUMNS])[0], errors
+
+
+def _normalize_trades(df):
+    out = pd.DataFrame({
+        '日付': parse_dates(df['日付']),
+        '区分': df['区分'].astype(str).str.strip(),
+        '証券コード': parse_codes(df['証券コード']),
+        '銘柄名': df['銘柄名'].astype(str).str.strip() if '銘柄名' in df.columns else "",
+        '数量': parse_numbers(df['数量']),
+        '約定単価': parse_numbers(df['約定単価']),
+        '平均単価': 0,
+        '確定損益': parse_numbers(df['確定損益']).fillna(0) if '確定損益' in df.columns else 0,
+        'ボーナス': _flags(df['ボーナス']) if 'ボーナス' in df.columns else False,
+    }, index=df.index)
+
+    trade = out['区分'].isin(BUY_TYPES + SELL_TYPES)
+    problems = pd.Series(np.select(
+        [out['日付'].isna(),
+         ~(trade | out['区分'].isin(NON_TRADE_TYPES)),
+         out['証券コード'] == "",
+         trade & ~(out['数量'] > 0),
+         trade & ~(out['約定単価'] >= 0)],
+        ["日付が読めません", "区分が不明です", "証券コードが空です", "数量が正しくありません", "約定単価が正しくありません"],
+        ""), index=df.index)
+    out['数量'] = out['数量'].fillna(0).astype('int64')
+    out['約定単価'] = out['約定単価'].fillna(0)
+    return _split(out, problems, df)
+
+
+def _normalize_past(df):
+    # past_data.csv の行は、銘柄コードを残したまま「データ調整」として確定損益 = 損益 で取り込む
+    out = pd.DataFrame({
+        '日付': parse_dates(df['日付']),
+        '区分': "データ調整",
+        '証券コード': parse_codes(df['証券コード']),
+        '銘柄名': df['銘柄名'].astype(str).str.strip() if '銘柄名' in df.columns else "",
+        '数量': parse_numbers(df['数量']).fillna(0) if '数量' in df.columns else 0,
+        '約定単価': 0,
+        '平均単価': 0,
+        '確定損益': parse_numbers(df['損益']),
+        'ボーナス': False,
+    }, index=df.index)
+
+    problems = pd.Series(np.select(
+        [out['日付'].isna(), out['証券コード'] == "", out['確定損益'].isna()],
+        ["日付が読めません", "証券コードが空です", "損益が読めません"],
+        ""), index=df.index)
+    out['数量'] = out['数量'].astype('int64')
+    out['確定損益'] = out['確定損益'].fillna(0)
+    return _split(out, problems, df)
+
+
+def fill_names(trades, lookup):
+    # 銘柄名が空の行だけ、lookup ({コード: 銘柄名} を返す一括取得) で埋める
+    missing = {t.code for t in trades if not t.name and t.kind.is_trade}
+    if not missing: return trades
+    names = lookup(sorted(missing))
+    for t in trades:
+        if not t.name: t.name = names.get(t.code, "")
+    return trades
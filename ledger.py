@@ -0,0 +1,539 @@
+import heapq
+import io
+import json
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from enum import IntEnum
+from operator import attrgetter, itemgetter
+
+import numpy as np
+import pandas as pd
+
+# --- 帳簿計算 ---
+
+BUY_TYPES = ["買い", "新規買付", "買い増し"]
+SELL_TYPES = ["売り", "売却"]
+NON_TRADE_TYPES = ["データ調整", "報酬精算"]
+LOG_COLUMNS = ['日付', '区分', '証券コード', '銘柄名', '数量', '約定単価', '平均単価', '確定損益', 'ボーナス']
+EDITABLE_COLUMNS = ['日付', '区分', '証券コード', '銘柄名', '数量', '約定単価', 'ボーナス']
+
+
+class TradeType(IntEnum):
+    # 区分。CSV には名前 (LABELS) で書く
+    BUY = 0
+    NEW_BUY = 1
+    ADD_BUY = 2
+    SELL = 3
+    SALE = 4
+    ADJUST = 5
+    PAYMENT = 6
+
+    @property
+    def label(self):
+        return LABELS[self]
+
+    @property
+    def is_buy(self):
+        return self <= TradeType.ADD_BUY
+
+    @property
+    def is_sell(self):
+        return TradeType.SELL <= self <= TradeType.SALE
+
+    @property
+    def is_trade(self):
+        return self <= TradeType.SALE
+
+
+LABELS = BUY_TYPES + SELL_TYPES + NON_TRADE_TYPES
+KINDS = {label: TradeType(i) for i, label in enumerate(LABELS)}
+
+
+def to_sen(value):
+    # 円 → 銭 (整数)。空や読めない値は 0
+    try: value = float(value)
+    except (TypeError, ValueError): return 0
+    return int(round(value * 100)) if value == value else 0
+
+
+def _div(total, qty):
+    # 銭単位の割り算 (四捨五入)
+    return (2 * total + qty) // (2 * qty) if qty > 0 else 0
+
+
+def _to_date(value):
+    if isinstance(value, datetime): return value.date()
+    if isinstance(value, date): return value
+    return date.fromisoformat(str(value).strip()[:10])
+
+
+def _to_flag(value):
+    if isinstance(value, str): return value.strip().lower() in ("true", "1")
+    return bool(value) and value == value
+
+
+class Trade:
+    # 取引1件。金額 (約定単価・平均単価・確定損益) は銭単位の整数で持つ。
+    # CSV の列名 (LOG_COLUMNS) との変換は読み書きのときだけ行う
+    __slots__ = ('date', 'kind', 'code', 'name', 'qty', 'price', 'avg', 'pl', 'bonus')
+
+    def __init__(self, date, kind, code, name="", qty=0, price=0, avg=0, pl=0, bonus=False):
+        self.date = date
+        self.kind = kind
+        self.code = sys.intern(code)
+        self.name = sys.intern(name)
+        self.qty = qty
+        self.price = price
+        self.avg = avg
+        self.pl = pl
+        self.bonus = bonus
+
+    @classmethod
+    def from_log(cls, log):
+        label = str(log['区分']).strip()
+        if label not in KINDS: raise ValueError(f"区分が不明です: {label}")
+        name = log.get('銘柄名')
+        return cls(_to_date(log['日付']), KINDS[label], str(log['証券コード']).strip(),
+                   "" if name is None or name != name else str(name),
+                   int(float(log.get('数量') or 0)), to_sen(log.get('約定単価')), to_sen(log.get('平均単価')),
+                   to_sen(log.get('確定損益')), _to_flag(log.get('ボーナス', False)))
+
+    def to_log(self):
+        return {'日付': self.date, '区分': self.kind.label, '証券コード': self.code, '銘柄名': self.name,
+                '数量': self.qty, '約定単価': self.price / 100, '平均単価': self.avg / 100,
+                '確定損益': self.pl / 100, 'ボーナス': self.bonus}
+
+    def copy(self):
+        return Trade(self.date, self.kind, self.code, self.name, self.qty, self.price, self.avg, self.pl, self.bonus)
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __setstate__(self, state):
+        for f, v in zip(self.__slots__, state): setattr(self, f, v)
+
+    def __repr__(self):
+        return f"Trade({self.date}, {self.kind.label}, {self.code}, qty={self.qty}, price={self.price / 100}, pl={self.pl / 100})"
+
+
+class Position:
+    # 1銘柄の保有状態 (金額は銭単位)
+    __slots__ = ('name', 'qty', 'avg', 'realized', 'original_avg')
+
+    def __init__(self, name, qty=0, avg=0, realized=0, original_avg=0):
+        self.name = name
+        self.qty = qty
+        self.avg = avg
+        self.realized = realized
+        self.original_avg = original_avg
+
+    def freeze(self):
+        return (self.name, self.qty, self.avg, self.realized, self.original_avg)
+
+    def to_dict(self):
+        return {'name': self.name, 'qty': self.qty, 'avg_price': self.avg / 100,
+                'realized_pl': self.realized / 100, 'original_avg': self.original_avg / 100}
+
+
+def trade_to_json(trade):
+    # 取引1件をイベントログ (JSONL) の1行にする
+    log = trade.to_log()
+    log['日付'] = trade.date.isoformat()
+    return json.dumps(log, ensure_ascii=False) + "\n"
+
+
+def skipped_rows(rows, reasons):
+    # 読み込めなかった行の表 (元の列 + 理由)。importer の「取り込めない行」と同じ形
+    return pd.DataFrame(rows).assign(理由=reasons)
+
+
+def trades_from_jsonl(text):
+    # (Trade のリスト, 読み込めない行の表)。壊れた行・区分が不明な行は飛ばす
+    trades, bad, reasons = [], [], []
+    for line in text.splitlines():
+        if not line.strip(): continue
+        log = None
+        try:
+            log = json.loads(line)
+            trades.append(Trade.from_log(log))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            bad.append(log if isinstance(log, dict) else {'行': line})
+            reasons.append(str(e))
+    return trades, skipped_rows(bad, reasons)
+
+
+def trades_from_frame(df):
+    # LOG_COLUMNS の表 → (Trade のリスト, 読み込めない行の表)。型の変換は列ごとにまとめて行う。
+    # 日付・区分が読めない行は全体を止めずに飛ばし、理由をつけて別に返す
+    dates = pd.to_datetime(df['日付'].astype(str).str.strip().str.replace("/", "-", regex=False), errors='coerce', format='ISO8601')
+    labels = df['区分'].astype(str).str.strip()
+    problems = np.select([dates.isna(), ~labels.isin(LABELS)], ["日付が読めません", "区分が不明です"], "")
+    bad = problems != ""
+    skipped = skipped_rows(df[bad], problems[bad])
+    if bad.any(): df, dates, labels = df[~bad], dates[~bad], labels[~bad]
+
+    n = len(df)
+    def col(name, default):
+        return df[name] if name in df.columns else pd.Series([default] * n, index=df.index, dtype=object)
+    def sen(name):
+        return (pd.to_numeric(col(name, 0), errors='coerce').fillna(0) * 100).round().astype('int64').tolist()
+
+    dates = dates.dt.date.tolist()
+    kinds = [KINDS[label] for label in labels]
+    codes = df['証券コード'].astype(str).str.strip().tolist()
+    names = col('銘柄名', "").fillna("").astype(str).tolist()
+    qtys = pd.to_numeric(col('数量', 0), errors='coerce').fillna(0).astype('int64').tolist()
+    bonus = [_to_flag(v) for v in col('ボーナス', False).tolist()]
+    return [Trade(*row) for row in zip(dates, kinds, codes, names, qtys, sen('約定単価'), sen('平均単価'), sen('確定損益'), bonus)], skipped
+
+
+def trades_frame(trades):
+    # Trade のリスト → LOG_COLUMNS の表 (金額は円)
+    return pd.DataFrame({
+        '日付': [t.date for t in trades],
+        '区分': [t.kind.label for t in trades],
+        '証券コード': [t.code for t in trades],
+        '銘柄名': [t.name for t in trades],
+        '数量': np.fromiter((t.qty for t in trades), dtype='int64', count=len(trades)),
+        '約定単価': np.fromiter((t.price for t in trades), dtype='int64', count=len(trades)) / 100,
+        '平均単価': np.fromiter((t.avg for t in trades), dtype='int64', count=len(trades)) / 100,
+        '確定損益': np.fromiter((t.pl for t in trades), dtype='int64', count=len(trades)) / 100,
+        'ボーナス': np.fromiter((t.bonus for t in trades), dtype=bool, count=len(trades)),
+    }, columns=LOG_COLUMNS)
+
+
+def trades_from_csv(data):
+    return trades_from_frame(pd.read_csv(io.BytesIO(data), encoding="utf-8", dtype={'証券コード': str}))
+
+
+def portfolio_from_csv(data):
+    df = pd.read_csv(io.BytesIO(data), encoding="utf-8")
+    df['Code'] = df['Code'].astype(str)
+    return df.set_index('Code').to_dict(orient='index')
+
+
+def apply_trade(positions, trade):
+    # 取引1件を positions ({コード: Position}) に反映し、trade の平均単価・確定損益・銘柄名を書き換える
+    settled = settle(positions, trade)
+    if settled: trade.avg, trade.pl, trade.name = settled
+
+
+def settle(positions, trade):
+    # 取引1件を positions に反映し、trade に書くべき (平均単価, 確定損益, 銘柄名) を返す。trade 自体は書き換えない
+    kind = trade.kind
+    if kind > TradeType.SALE: return None
+    code = trade.code
+    cur = positions.get(code)
+    held = cur.name if cur else None
+
+    if trade.name and "コード(" not in trade.name: final_name = trade.name
+    elif held and "コード(" not in held: final_name = held
+    else: final_name = trade.name or f"コード({code})"
+
+    if kind <= TradeType.ADD_BUY:
+        if cur is None: cur = positions[code] = Position(final_name)
+        base_avg = cur.original_avg
+        if base_avg == 0 and cur.qty == 0: base_avg = trade.price
+        elif base_avg == 0 and cur.avg > 0: base_avg = cur.avg
+
+        total_qty = cur.qty + trade.qty
+        cur.avg = _div(cur.qty * cur.avg + trade.qty * trade.price, total_qty)
+        cur.original_avg = _div(cur.qty * base_avg + trade.qty * trade.price, total_qty)
+        cur.qty = total_qty
+        cur.name = final_name
+        return cur.avg, 0, final_name
+
+    if cur is None: return None
+    if trade.bonus:
+        pl = trade.qty * trade.price - cur.qty * cur.avg
+        cur.avg = 0
+    else:
+        pl = (trade.price - cur.avg) * trade.qty
+    cur.qty = max(0, cur.qty - trade.qty)
+    cur.realized += pl
+    return cur.avg, pl, cur.name
+
+
+def recalculate_all(trades):
+    sorted_trades = sorted(trades, key=attrgetter('date'))
+    positions = {}
+    for trade in sorted_trades:
+        apply_trade(positions, trade)
+    return {code: p.to_dict() for code, p in positions.items()}, sorted_trades
+
+
+class _History:
+    # 1銘柄分の取引（日付順）と、各取引を適用した直後の保有状態
+    __slots__ = ('keys', 'trades', 'states')
+
+    def __init__(self):
+        self.keys = []
+        self.trades = []
+        self.states = []
+
+
+class LedgerEngine:
+    # 銘柄ごとの保有状態を持ち続け、取引の追加を差分だけで反映する帳簿。
+    # 結果は recalculate_all（全件の再計算）と一致する。
+    # shared=True (または share() のあと) は、渡された取引を書き換えない: 再計算で値が変わる取引だけを写しに取り替える
+    def __init__(self, trades=(), shared=False):
+        self.positions = {}
+        self.trades = []
+        self._keys = []
+        self._history = {}
+        self._first_buy = {}
+        self._seq = 0
+        self._portfolio = None
+        self._owned = set() if shared else None
+        for trade in sorted(trades, key=attrgetter('date')):
+            self._add(trade)
+
+    def share(self):
+        # いまの取引はすべて公開済みとして、これ以降は書き換えない
+        self._owned = set()
+
+    def _apply(self, positions, trade):
+        # 取引を反映し、書き換えた取引を返す。公開済みの取引で値が変わるときは写しを返す
+        settled = settle(positions, trade)
+        if settled is None or (trade.avg, trade.pl, trade.name) == settled: return trade
+        if self._owned is not None and id(trade) not in self._owned:
+            trade = trade.copy()
+            self._owned.add(id(trade))
+        trade.avg, trade.pl, trade.name = settled
+        return trade
+
+    @property
+    def portfolio(self):
+        # 表示・保存用の {コード: {'name', 'qty', 'avg_price', ...}} (金額は円)。変更があるまで使い回す
+        if self._portfolio is None:
+            self._portfolio = {code: p.to_dict() for code, p in self.positions.items()}
+        return self._portfolio
+
+    def _next_key(self, trade):
+        # 同じ日付の取引は追加順に並べる（sorted の安定ソートと同じ順序）
+        key = (trade.date, self._seq)
+        self._seq += 1
+        return key
+
+    def append(self, trade):
+        # 追加した取引はこの帳簿のもの (公開するまでは書き換えてよい)
+        if self._owned is not None: self._owned.add(id(trade))
+        self._add(trade)
+
+    def _add(self, trade):
+        self._portfolio = None
+        key = self._next_key(trade)
+        if self._keys and key < self._keys[-1]:
+            self._insert(trade, key)
+            return
+
+        if trade.kind <= TradeType.SALE:
+            trade = self._apply(self.positions, trade)
+            code = trade.code
+            h = self._history.setdefault(code, _History())
+            h.keys.append(key)
+            h.trades.append(trade)
+            cur = self.positions.get(code)
+            h.states.append(cur.freeze() if cur else None)
+            if cur: self._first_buy.setdefault(code, key)
+        self.trades.append(trade)
+        self._keys.append(key)
+
+    def _insert(self, trade, key):
+        # 過去日付の取引: 挿入位置以降のその銘柄の履歴だけを再計算する
+        i = bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self.trades.insert(i, trade)
+        if not trade.kind.is_trade: return
+
+        h = self._history.setdefault(trade.code, _History())
+        j = bisect_right(h.keys, key)
+        h.keys.insert(j, key)
+        h.trades.insert(j, trade)
+        self._replay(trade.code, j)
+
+    def splice(self, removed=(), replaced=(), added=()):
+        # 削除・差し替え・追加をまとめて反映し、影響のあった銘柄だけを再計算する。
+        # removed は self.trades 内の Trade、replaced は (元の Trade, 新しい Trade) の組
+        self._portfolio = None
+        pos = {id(trade): i for i, trade in enumerate(self.trades)}
+        drop = [pos[id(trade)] for trade in removed]
+        new_entries = []
+        for old, trade in replaced:
+            i = pos[id(old)]
+            drop.append(i)
+            new_entries.append(((trade.date, self._keys[i][1]), trade))
+        for trade in added:
+            new_entries.append((self._next_key(trade), trade))
+        if self._owned is not None: self._owned.update(id(trade) for _, trade in new_entries)
+
+        affected = {}
+        dropped_keys = {self._keys[i] for i in drop}
+        for key, trade in [(self._keys[i], self.trades[i]) for i in drop] + new_entries:
+            if not trade.kind.is_trade: continue
+            affected[trade.code] = min(affected.get(trade.code, key), key)
+
+        new_entries.sort(key=itemgetter(0))
+        if len(drop) + len(new_entries) <= 64:
+            for i in sorted(drop, reverse=True):
+                del self._keys[i]
+                del self.trades[i]
+            for key, trade in new_entries:
+                i = bisect_right(self._keys, key)
+                self._keys.insert(i, key)
+                self.trades.insert(i, trade)
+        else:
+            dropped = set(drop)
+            kept = ((k, trade) for i, (k, trade) in enumerate(zip(self._keys, self.trades)) if i not in dropped)
+            merged = list(heapq.merge(kept, new_entries, key=itemgetter(0)))
+            self._keys = [k for k, _ in merged]
+            self.trades = [trade for _, trade in merged]
+
+        added_by_code = {}
+        for key, trade in new_entries:
+            if not trade.kind.is_trade: continue
+            added_by_code.setdefault(trade.code, []).append((key, trade))
+
+        # 銘柄ごとに、最初に変更のあった位置より後ろだけを組み直して再計算する
+        for code, start_key in affected.items():
+            h = self._history.setdefault(code, _History())
+            start = bisect_left(h.keys, start_key)
+            tail = [(k, trade) for k, trade in zip(h.keys[start:], h.trades[start:]) if k not in dropped_keys]
+            tail = list(heapq.merge(tail, added_by_code.get(code, []), key=itemgetter(0)))
+            h.keys[start:] = [k for k, _ in tail]
+            h.trades[start:] = [trade for _, trade in tail]
+            self._replay(code, start)
+            if not h.keys: del self._history[code]
+
+    def _replay(self, code, start):
+        h = self._history[code]
+        before = h.states[start - 1] if start > 0 else None
+        work = {code: Position(*before)} if before else {}
+        del h.states[start:]
+        for j in range(start, len(h.trades)):
+            trade = h.trades[j]
+            settled = self._apply(work, trade)
+            if settled is not trade:
+                h.trades[j] = settled
+                self.trades[bisect_left(self._keys, h.keys[j])] = settled
+            cur = work.get(code)
+            h.states.append(cur.freeze() if cur else None)
+
+        first_buy = next((k for k, trade in zip(h.keys, h.trades) if trade.kind.is_buy), None)
+        if code in work: self.positions[code] = work[code]
+        else: self.positions.pop(code, None)
+
+        # positions の並び順は「最初の買い」の順。変わったときだけ並べ直す
+        if first_buy != self._first_buy.get(code):
+            if first_buy is None: self._first_buy.pop(code, None)
+            else: self._first_buy[code] = first_buy
+            self.positions = {c: self.positions[c] for c in sorted(self.positions, key=self._first_buy.__getitem__)}
+
+
+class LedgerConflict(Exception):
+    pass
+
+
+class LedgerState:
+    # 全セッションで共有する帳簿の1つの版。公開したあとは書き換えない。
+    # skipped は保存先のファイルにあるが読み込めなかった行の表 (無ければ None)
+    __slots__ = ('version', 'portfolio', 'trades', 'event_count', 'sources', 'skipped')
+
+    def __init__(self, version, portfolio, trades, event_count=0, sources=None, skipped=None):
+        self.version = version
+        self.portfolio = portfolio
+        self.trades = trades
+        self.event_count = event_count
+        self.sources = sources
+        self.skipped = skipped
+
+
+class LedgerStore:
+    # プロセス全体で1つの帳簿。読む側は current を受け取り、版の番号が変わったときだけ取り替える。
+    # 書く側は write で、公開中の版と取引を共有する LedgerEngine に変更を加えて新しい版を公開する (copy-on-write)。
+    # 帳簿は公開済みの取引を書き換えず、再計算で値の変わる取引だけを写すので、版どうしは変わらなかった取引を共有する。
+    # sources には読み込んだときの保存先のファイルの版を持たせ、保存先との突き合わせに使う。
+    # 書き込めるのは保存先から読んだ (または突き合わせて verify した) 版とそこから書いた版だけ
+    def __init__(self):
+        self.current = None
+        self._engine = None
+        self._verified = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @property
+    def verified(self):
+        return self.current is not None and self.current.version == self._verified
+
+    def verify(self, version):
+        # 手元のスナップショットから公開した版が保存先と同じだと確かめられたら、書き込めるようにする
+        with self._lock:
+            if self.version == version: self._verified = version
+
+    @property
+    def version(self):
+        return self.current.version if self.current else 0
+
+    def publish(self, portfolio, trades, event_count=0, sources=None, engine=None, skipped=None, verified=True):
+        # 読み込んだ状態をそのまま新しい版にする。trades は以後どこからも書き換えないこと。
+        # 読み込みに失敗したときは公開しないこと (空の帳簿の上に書き込まれてしまう)。
+        # trades を組み立てた LedgerEngine があれば渡す (次の書き込みで組み直さずに使う)。
+        # 保存先と突き合わせていない状態 (手元のスナップショット) は verified=False にする
+        with self._lock:
+            if engine is not None:
+                engine.share()
+                trades = engine.trades
+            else:
+                trades = sorted(trades, key=attrgetter('date'))
+            self._engine = engine
+            self.current = state = LedgerState(self.version + 1, portfolio, tuple(trades), event_count, sources, skipped)
+            if verified: self._verified = state.version
+        if engine is None: threading.Thread(target=self._prepare, args=(state,), daemon=True).start()
+        return state
+
+    def _prepare(self, state):
+        # 最初の書き込みを待たせないよう、公開した版の帳簿を裏で組んでおく (公開済みの取引は書き換えない)
+        engine = LedgerEngine(state.trades, shared=True)
+        with self._lock:
+            if self.current is state and self._engine is None: self._engine = engine
+
+    def ensure(self, load):
+        # まだ版が無ければ load() で読み込む。同時に呼ばれても読み込むのは1回。
+        # load が例外で終われば何も公開されず、次に呼ばれたときにもう一度読み込む
+        with self._load_lock:
+            if self.current is None: load()
+        return self.current
+
+    def reload(self, load, seen):
+        # 公開中の版が seen のままなら load() で読み直す。ほかのセッションが先に読み直していれば何もしない
+        with self._load_lock:
+            if self.version == seen: load()
+        return self.current
+
+    def write(self, change, base=None):
+        # change(engine, state) で帳簿を書き換えて保存し、成功したら (event_count, sources) を返す。
+        # 成功すれば新しい版を公開して返し、失敗 (None・例外) なら帳簿を捨てて None を返す。
+        # base (書き込みの元にした版) が公開中の版と違うとき、公開中の版を保存先から読んだと確かめられないときは LedgerConflict
+        with self._lock:
+            state = self.current
+            if state is None or state.version != self._verified:
+                raise LedgerConflict("保存先の内容をまだ確認できていません。しばらくしてからもう一度操作してください")
+            if base is not None and state.version != base:
+                raise LedgerConflict("ほかの更新が先に保存されました。最新の内容を確認してからもう一度操作してください")
+            if self._engine is None: self._engine = LedgerEngine(state.trades, shared=True)
+            try:
+                result = change(self._engine, state)
+            except Exception:
+                self._engine = None
+                raise
+            if not result:
+                self._engine = None
+                return None
+            event_count, sources = result
+            engine = self._engine
+            engine.share()
+            self.current = LedgerState(state.version + 1, engine.portfolio, tuple(engine.trades), event_count, sources, state.skipped)
+            self._verified = self.current.version
+            return self.current
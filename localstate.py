@@ -0,0 +1,73 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+import pandas as pd
+
+from columnar import read_table, trades_from_table, trades_to_arrow
+
+# --- 手元に残す状態のスナップショット ---
+# 最後に読み込んだ 保有・取引履歴 と、そのときの保存先のファイルの版を1つの Arrow ファイルに書いておく。
+# ファイル名は内容の sha1 で、HEAD に最新のファイル名を書く。起動直後はこれを表示し、保存先との突き合わせは後で行う
+
+
+class LocalSnapshot:
+    def __init__(self, root, keep=2):
+        self.root = root
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def load(self):
+        # (portfolio, trades, versions, event_count, skipped)。無い・壊れている・内容がハッシュと合わないときは None
+        try:
+            with open(self._path("HEAD"), encoding="utf-8") as f:
+                name = f.read().strip()
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+            if hashlib.sha1(data).hexdigest() != name.removesuffix(".arrow"): return None
+            table = read_table(data)
+            meta = table.schema.metadata
+            skipped = pd.read_json(io.StringIO(meta[b"skipped"].decode()), orient="records") if b"skipped" in meta else None
+            return (json.loads(meta[b"portfolio"]), trades_from_table(table)[0],
+                    json.loads(meta[b"versions"]), int(meta[b"event_count"]), skipped)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, portfolio, trades, versions, event_count=0, skipped=None):
+        # 同じ内容なら書き直さない。戻り値はファイル名 (内容の sha1)。skipped は読み込めなかった行の表
+        try:
+            meta = {
+                b"portfolio": json.dumps(portfolio, ensure_ascii=False).encode(),
+                b"versions": json.dumps(versions).encode(),
+                b"event_count": str(event_count).encode(),
+            }
+            if skipped is not None: meta[b"skipped"] = skipped.to_json(orient="records", force_ascii=False, date_format="iso").encode()
+            data = trades_to_arrow(trades, meta)
+        except (TypeError, ValueError):
+            return None
+        name = hashlib.sha1(data).hexdigest() + ".arrow"
+        with self._lock:
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                if not os.path.exists(self._path(name)): self._write(name, data)
+                self._write("HEAD", name.encode())
+                self._prune(name)
+            except OSError:
+                return None
+        return name
+
+    def _write(self, name, data):
+        tmp = self._path(f".{name}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def _prune(self, current):
+        files = sorted((e for e in os.scandir(self.root) if e.name.endswith(".arrow") and e.name != current),
+                       key=lambda e: e.stat().st_mtime, reverse=True)
+        for entry in files[self.keep - 1:]: os.remove(entry.path)
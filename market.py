@@ -0,0 +1,115 @@
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+# --- 東証の営業日・取引時間 ---
+# 株価キャッシュの期限をここで決める。取引時間中は ttl 秒、引け後は次の寄り付きまで有効にする
+
+JST = ZoneInfo("Asia/Tokyo")
+
+# 前場・後場 (2024年11月から大引けは 15:30)
+SESSIONS = ((time(9, 0), time(11, 30)), (time(12, 30), time(15, 30)))
+
+
+def _nth_monday(year, month, n):
+    first = date(year, month, 1)
+    return first + timedelta(days=(7 - first.weekday()) % 7 + 7 * (n - 1))
+
+
+def _equinoxes(year):
+    # 春分・秋分の日 (1980〜2099年の近似式)
+    y = year - 1980
+    spring = int(20.8431 + 0.242194 * y - y // 4)
+    autumn = int(23.2488 + 0.242194 * y - y // 4)
+    return date(year, 3, spring), date(year, 9, autumn)
+
+
+@lru_cache(maxsize=None)
+def national_holidays(year):
+    # 国民の祝日 (振替休日・国民の休日を含む)。2000年以降のみ
+    spring, autumn = _equinoxes(year)
+    days = {
+        date(year, 1, 1), _nth_monday(year, 1, 2), date(year, 2, 11), spring,
+        date(year, 4, 29), date(year, 5, 3), date(year, 5, 4), date(year, 5, 5),
+        _nth_monday(year, 9, 3), autumn, date(year, 11, 3), date(year, 11, 23),
+    }
+    if year >= 2020: days.add(date(year, 2, 23))
+    elif year <= 2018: days.add(date(year, 12, 23))
+
+    # 海の日・山の日・スポーツの日 (五輪の年は特例で移動)
+    moved = {2020: (date(2020, 7, 23), date(2020, 8, 10), date(2020, 7, 24)),
+             2021: (date(2021, 7, 22), date(2021, 8, 9), date(2021, 7, 23))}
+    if year in moved:
+        days.update(moved[year])
+    else:
+        days.add(_nth_monday(year, 7, 3))
+        days.add(_nth_monday(year, 10, 2))
+        if year >= 2016: days.add(date(year, 8, 11))
+    if year == 2019:
+        days.update({date(2019, 4, 30), date(2019, 5, 1), date(2019, 5, 2), date(2019, 10, 22)})
+
+    # 祝日に挟まれた平日は国民の休日
+    for day in sorted(days):
+        between = day + timedelta(days=1)
+        if between not in days and between + timedelta(days=1) in days and between.weekday() != 6:
+            days.add(between)
+    # 日曜の祝日は、その後の最初の祝日でない日が振替休日
+    for day in sorted(days):
+        if day.weekday() == 6:
+            sub = day + timedelta(days=1)
+            while sub in days: sub += timedelta(days=1)
+            days.add(sub)
+    return frozenset(days)
+
+
+class TseCalendar:
+    # 東証の営業日と取引時間。closed_days で臨時休場日を足せる。
+    # settle: 引けのあと値が確定するまで (yfinance の配信遅れ) は ttl 秒ごとに取り直す
+    def __init__(self, sessions=SESSIONS, closed_days=(), settle=1200):
+        self.sessions = sessions
+        self.closed_days = {date.fromisoformat(str(d)) for d in closed_days}
+        self.settle = settle
+
+    def is_trading_day(self, day):
+        if day.weekday() >= 5 or day in self.closed_days: return False
+        if (day.month, day.day) in ((12, 31), (1, 1), (1, 2), (1, 3)): return False
+        return day not in national_holidays(day.year)
+
+    def _day_sessions(self, day):
+        if not self.is_trading_day(day): return []
+        return [(datetime.combine(day, o, JST), datetime.combine(day, c, JST)) for o, c in self.sessions]
+
+    def session_at(self, ts):
+        # ts (JST の datetime) が取引時間中ならその場の (寄り, 引け)
+        for start, end in self._day_sessions(ts.date()):
+            if start <= ts < end: return start, end
+        return None
+
+    def is_open(self, ts=None):
+        return self.session_at(ts or datetime.now(JST)) is not None
+
+    def next_open(self, ts):
+        day = ts.date()
+        for _ in range(30):
+            for start, _end in self._day_sessions(day):
+                if start > ts: return start
+            day += timedelta(days=1)
+        return ts + timedelta(days=1)
+
+    def last_close(self, ts):
+        day = ts.date()
+        for _ in range(30):
+            for _start, end in reversed(self._day_sessions(day)):
+                if end <= ts: return end
+            day -= timedelta(days=1)
+        return None
+
+    def expiry(self, fetched_at, ttl):
+        # fetched_at (UNIX 秒) に取った株価の有効期限 (UNIX 秒)
+        ts = datetime.fromtimestamp(fetched_at, JST)
+        session = self.session_at(ts)
+        if session: return min(fetched_at + ttl, session[1].timestamp() + self.settle)
+        close = self.last_close(ts)
+        if close and fetched_at < close.timestamp() + self.settle:
+            return min(fetched_at + ttl, close.timestamp() + self.settle)
+        return self.next_open(ts).timestamp()
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+from importer import parse_codes, parse_dates, parse_numbers
+
+# --- 過去データ (past_data) ---
+# 日付が "2024" と "2024/03/24" のように混ざった CSV を、型のそろった列と勝敗の区分に一度だけ直す。
+# 表の色付けと集計はこの表から列単位で作る
+
+PAST_COLUMNS = ['年', '日付', '証券コード', '銘柄名', '数量', '損益', '取引形態', '勝敗']
+OUTCOMES = ['利確', '損切', '±0']
+OUTCOME_STYLES = {'利確': 'background-color: #ffe6e6; color: black', '損切': 'background-color: #e6f2ff; color: black', '±0': ''}
+
+
+def normalize_past(df):
+    # 年だけの日付は 日付 を空にして 年 だけ持つ。勝敗は 取引形態 (利確/損切) を優先し、無ければ損益の符号で決める
+    text = df['日付'].astype(str).str.strip()
+    dates = pd.to_datetime(parse_dates(df['日付']))
+    pl = parse_numbers(df['損益']) if '損益' in df.columns else pd.Series(np.nan, index=df.index)
+    kind = df['取引形態'].fillna("").astype(str).str.strip() if '取引形態' in df.columns else pd.Series("", index=df.index)
+
+    outcome = np.select(
+        [kind.str.contains('利確', regex=False), kind.str.contains('損切', regex=False), pl > 0, pl < 0],
+        ['利確', '損切', '利確', '損切'], '±0')
+    return pd.DataFrame({
+        '年': dates.dt.year.astype('Int64'),
+        '日付': dates.where(~text.str.fullmatch(r"\d{4}")).dt.date,
+        '証券コード': parse_codes(df['証券コード']),
+        '銘柄名': df['銘柄名'].fillna("").astype(str).str.strip() if '銘柄名' in df.columns else "",
+        '数量': parse_numbers(df['数量']).fillna(0).astype('int64') if '数量' in df.columns else 0,
+        '損益': pl,
+        '取引形態': kind,
+        '勝敗': pd.Categorical(outcome, categories=OUTCOMES),
+    }, index=df.index)[PAST_COLUMNS]
+
+
+def past_styles(past):
+    # Styler.apply(axis=None) に渡す、表と同じ形の CSS の表
+    css = past['勝敗'].map(OUTCOME_STYLES).astype(object).fillna('').to_numpy()
+    return pd.DataFrame(np.repeat(css[:, None], past.shape[1], axis=1), index=past.index, columns=past.columns)
+
+
+def past_stats(past):
+    # 年ごとの損益・件数・勝率と、利確/損切それぞれの合計を1回の groupby で出す
+    grouped = past.groupby(['年', '勝敗'], observed=False)['損益'].agg(['sum', 'count']).unstack('勝敗', fill_value=0)
+    total, count = grouped['sum'], grouped['count']
+    decided = count['利確'] + count['損切']
+    by_year = pd.DataFrame({
+        '損益': total.sum(axis=1),
+        '件数': count.sum(axis=1),
+        '勝率%': (count['利確'] / decided.where(decided > 0) * 100).round(1),
+        '利確合計': total['利確'],
+        '損切合計': total['損切'],
+    })
+    by_year.index = by_year.index.astype(str)
+    overall = by_year[['損益', '件数', '利確合計', '損切合計']].sum()
+    overall['勝率%'] = round(count['利確'].sum() / max(1, decided.sum()) * 100, 1)
+    return by_year, overall
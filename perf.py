@@ -0,0 +1,87 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# --- 計測 ---
+# 処理ごとの所要時間 (span) と回数・バイト数 (counter) を記録する。
+# 記録は1行1件の JSON としてログ "perf" に出し、直近 window 件から p50/p95/p99 を出せるように残しておく。
+# counter は再実行ごとに合計を1行にまとめて出す (再実行の外で数えたものはその場で1行ずつ出す)
+
+logger = logging.getLogger("perf")
+
+
+def configure(level="INFO", stream=None):
+    # ログ "perf" の出力先とレベル。何度呼んでもハンドラは1つだけ
+    logger.setLevel(level)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(asctime)s perf %(message)s"))
+        logger.addHandler(handler)
+
+_lock = threading.Lock()
+_local = threading.local()
+_spans = defaultdict(lambda: deque(maxlen=500))
+_counters = defaultdict(int)
+
+
+def record(name, ms, **fields):
+    # 計り終えた所要時間 (ミリ秒) を span と同じように残す
+    with _lock:
+        _spans[name].append(ms)
+    current = getattr(_local, "run", None)
+    if current is not None: current.append((name, ms))
+    logger.info(json.dumps({"span": name, "ms": round(ms, 2), **fields}, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name, **fields):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - t) * 1000, **fields)
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] += n
+    counts = getattr(_local, "counts", None)
+    if counts is not None: counts[name] = counts.get(name, 0) + n
+    elif logger.isEnabledFor(logging.INFO): logger.info(json.dumps({"counter": name, "n": n}, ensure_ascii=False))
+
+
+@contextmanager
+def run():
+    # 1回の再実行のあいだに記録した span を (名前, ミリ秒) のリストで受け取る
+    spans = []
+    counts = {}
+    outer, outer_counts = getattr(_local, "run", None), getattr(_local, "counts", None)
+    _local.run, _local.counts = spans, counts
+    try:
+        with span("rerun"):
+            yield spans
+    finally:
+        _local.run, _local.counts = outer, outer_counts
+        if outer is not None: outer.extend(spans)
+        if outer_counts is not None:
+            for name, n in counts.items(): outer_counts[name] = outer_counts.get(name, 0) + n
+        elif counts:
+            logger.info(json.dumps({"counters": counts}, ensure_ascii=False))
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def percentiles():
+    # 処理ごとの回数と p50/p95/p99 (ミリ秒)
+    import numpy as np
+    with _lock:
+        samples = {name: np.array(values) for name, values in _spans.items() if values}
+    return [{'処理': name, '回数': len(v), 'p50': np.percentile(v, 50), 'p95': np.percentile(v, 95), 'p99': np.percentile(v, 99)}
+            for name, v in sorted(samples.items())]
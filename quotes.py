@@ -0,0 +1,256 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import perf
+from market import JST, TseCalendar
+
+# --- 株価取得エンジン ---
+
+SYSTEM_CODES = ["ADJUST", "PAYMENT"]
+SYSTEM_INFO = ("システム調整", 0, 0, 0)
+
+
+class TokenBucket:
+    # 全ワーカーで共有するレート制限（毎秒 rate 件、最大 capacity 件まで連続で許可）
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QuoteStore:
+    # SQLite の二層キャッシュ（銘柄名: 長期保持 / 株価: 短期保持）。件数を超えたら古い順に削除
+    def __init__(self, path, max_entries=500):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS names (code TEXT PRIMARY KEY, name TEXT, updated_at REAL, used_at REAL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS prices (code TEXT PRIMARY KEY, price REAL, change REAL, pct REAL, fetched_at REAL, used_at REAL)")
+
+    def _get(self, table, cols, code):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {cols} FROM {table} WHERE code = ?", (code,)).fetchone()
+            if row: self._conn.execute(f"UPDATE {table} SET used_at = ? WHERE code = ?", (time.time(), code))
+        return row
+
+    def _put(self, table, cols, values):
+        now = time.time()
+        marks = ", ".join("?" * (len(values) + 2))
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO {table} ({cols}, used_at) VALUES ({marks})", (*values, now, now))
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE code NOT IN (SELECT code FROM {table} ORDER BY used_at DESC LIMIT ?)",
+                (self.max_entries,))
+
+    def get_name(self, code):
+        return self._get("names", "name, updated_at", code)
+
+    def put_name(self, code, name):
+        self._put("names", "code, name, updated_at", (code, name))
+
+    def get_price(self, code):
+        row = self._get("prices", "price, change, pct, fetched_at", code)
+        return (row[:3], row[3]) if row else None
+
+    def put_price(self, code, quote):
+        self._put("prices", "code, price, change, pct, fetched_at", (code, *quote))
+
+
+# yfinance は読み込みに時間がかかるので、最初に取得するときに import する
+def fetch_stock_name(code):
+    import yfinance as yf
+    try:
+        info = yf.Ticker(f"{code}.T").info
+        return info.get('longName') or info.get('shortName')
+    except:
+        return None
+
+
+def fetch_stock_price(code):
+    import yfinance as yf
+    try:
+        ticker = yf.Ticker(f"{code}.T")
+        price = ticker.fast_info.last_price
+        prev_close = ticker.fast_info.previous_close
+
+        if price is None or price == 0:
+            hist = ticker.history(period="1d")
+            if not hist.empty:
+                price = hist['Close'].iloc[-1]
+                prev_close = price
+
+        if price is None: price = 0
+        if prev_close is None: prev_close = 0
+
+        change = 0
+        pct_change = 0
+        if price > 0 and prev_close > 0:
+            change = price - prev_close
+            pct_change = (change / prev_close) * 100
+
+        return float(price), float(change), float(pct_change)
+    except:
+        return 0, 0, 0
+
+
+class QuoteEngine:
+    # 銘柄コード → (銘柄名, 現在値, 前日比, 騰落率%) をまとめて取得する
+    # 期限切れの株価はそのまま返し、裏で再取得する (stale-while-revalidate)。
+    # snapshot で見た銘柄は watch_ttl 秒のあいだ監視対象になり、全セッション共通の更新スレッドが
+    # refresh_interval 秒ごとに期限切れ間近のものを取り直しておく。
+    # 株価の期限は calendar (東証の取引時間) で決まり、ttl は取引時間中の有効秒数
+    def __init__(self, store=None, ttl=300, name_ttl=30 * 86400, max_workers=8, rate=8.0, burst=8,
+                 refresh_interval=30, watch_ttl=3600, calendar=None):
+        self.store = store or QuoteStore(":memory:")
+        self.ttl = ttl
+        self.calendar = calendar or TseCalendar()
+        self.name_ttl = name_ttl
+        self.max_workers = max_workers
+        self.refresh_interval = refresh_interval
+        self.watch_ttl = watch_ttl
+        self.bucket = TokenBucket(rate, burst)
+        self._refresher = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="quote-refresh")
+        self._inflight = set()
+        self._watched = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get_name(self, code):
+        code = str(code).strip()
+        if code in SYSTEM_CODES: return SYSTEM_INFO[0]
+        hit = self.store.get_name(code)
+        if hit and self._name_fresh(hit):
+            perf.count("quote.name.hit")
+            return hit[0]
+
+        perf.count("quote.name.miss")
+        self.bucket.acquire()
+        with perf.span("quote.fetch_name", code=code):
+            name = fetch_stock_name(code)
+        if name: self.store.put_name(code, name)
+        elif hit: name = hit[0]
+        else:
+            # 取得失敗も株価と同じ期間だけ覚えておき、毎回問い合わせないようにする
+            name = f"コード({code})"
+            self.store.put_name(code, name)
+        return name
+
+    def _name_fresh(self, hit):
+        name, updated_at = hit
+        limit = self.ttl if name.startswith("コード(") else self.name_ttl
+        return time.time() - updated_at < limit
+
+    def _expired(self, fetched_at, now=None):
+        return (now or time.time()) >= self.calendar.expiry(fetched_at, self.ttl)
+
+    def _fetch_price(self, code):
+        self.bucket.acquire()
+        with perf.span("quote.fetch_price", code=code):
+            quote = fetch_stock_price(code)
+        self.store.put_price(code, quote)
+        return quote
+
+    def _revalidate(self, code):
+        with self._lock:
+            if code in self._inflight: return
+            self._inflight.add(code)
+
+        def run():
+            try:
+                self.get_name(code)
+                self._fetch_price(code)
+            finally:
+                with self._lock: self._inflight.discard(code)
+        self._refresher.submit(run)
+
+    def _cached(self, code):
+        # 保存済みの株価を返す。期限切れなら再取得を予約した上で古い値を返す
+        hit = self.store.get_price(code)
+        if not hit:
+            perf.count("quote.price.miss")
+            return None
+        quote, fetched_at = hit
+        if self._expired(fetched_at):
+            perf.count("quote.price.stale")
+            self._revalidate(code)
+        else:
+            perf.count("quote.price.hit")
+        return quote
+
+    def get_names(self, codes):
+        # 銘柄名だけをまとめて引く（キャッシュに無いものは並列に取得）
+        codes = list(dict.fromkeys(str(c).strip() for c in codes))
+        if not codes: return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(codes))) as pool:
+            return dict(zip(codes, pool.map(self.get_name, codes)))
+
+    def snapshot(self, codes):
+        # 待たずに手元の最新値を返す: {コード: ((銘柄名, 現在値, 前日比, 騰落率%), 状態)}。
+        # 状態は fresh / stale (期限切れ・取り直し中) / pending (未取得・取得中。値は None)
+        now = time.time()
+        result = {}
+        for code in dict.fromkeys(str(c).strip() for c in codes):
+            if code in SYSTEM_CODES:
+                result[code] = (SYSTEM_INFO, "fresh")
+                continue
+            with self._lock: self._watched[code] = now
+
+            name = self.store.get_name(code)
+            hit = self.store.get_price(code)
+            if not hit:
+                perf.count("quote.price.miss")
+                self._revalidate(code)
+                result[code] = ((name[0] if name else None, None, None, None), "pending")
+                continue
+
+            quote, fetched_at = hit
+            stale = self._expired(fetched_at, now)
+            perf.count("quote.price.stale" if stale else "quote.price.hit")
+            if stale or not (name and self._name_fresh(name)): self._revalidate(code)
+            result[code] = ((name[0] if name else None,) + tuple(quote), "stale" if stale else "fresh")
+        self._start_refresher()
+        return result
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._thread: return
+            self._thread = threading.Thread(target=self._refresh_loop, name="quote-refresher", daemon=True)
+        self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            now = time.time()
+            with self._lock:
+                for code, seen in list(self._watched.items()):
+                    if now - seen > self.watch_ttl: del self._watched[code]
+                codes = list(self._watched)
+            # 取引時間中は期限が切れる少し前に取り直し、表示のときには新しい値が揃っているようにする。
+            # 取引時間外は期限 (次の寄り付き) が来るまで何もしない
+            lead = self.refresh_interval if self.calendar.is_open(datetime.fromtimestamp(now, JST)) else 0
+            for code in codes:
+                hit = self.store.get_price(code)
+                if not hit or self._expired(hit[1], now + lead): self._revalidate(code)
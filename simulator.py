@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+# --- 恩株シミュレーター ---
+# 全保有銘柄 × 上昇率 × 売買単位 の組み合わせを NumPy の配列計算でまとめて求める
+
+DEFAULT_RATES = [0, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200]
+
+
+def parse_rates(text):
+    # "0, 5, 10" のような入力を上昇率 (%) のリストにする。読めない値は無視する
+    rates = []
+    for part in str(text).replace("、", ",").split(","):
+        try: rates.append(float(part.strip().rstrip("%")))
+        except ValueError: pass
+    return sorted(set(rates)) or DEFAULT_RATES
+
+
+def required_sells(remaining, prices, lots):
+    # remaining: 回収が残っている元本 (銘柄数,)、prices: 想定売却単価 (銘柄数, 上昇率数)、lots: 売買単位 (単位数,)。
+    # 戻り値は (銘柄数, 上昇率数, 単位数) の必要売却数。回収済みは 0、単価が 0 で計算できない場合は -1。
+    # 保有数を超えていれば、その条件では恩株化できない
+    remaining = np.asarray(remaining, dtype=float)[:, None, None]
+    prices = np.asarray(prices, dtype=float)[:, :, None]
+    lots = np.asarray(lots, dtype=float)[None, None, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw = np.ceil(remaining / prices)
+        needed = np.ceil(raw / lots) * lots
+    needed = np.where(remaining <= 0, 0, needed)
+    return np.where(np.isfinite(needed) & (needed >= 0), needed, -1).astype('int64')
+
+
+def onkabu_grid(holdings, rates, lots=(100,)):
+    # 平均取得単価から +rate% で売ったときに恩株化に必要な最小売却数。
+    # 列は (売買単位, 上昇率) の MultiIndex、行は銘柄コード
+    avg = holdings['avg_price'].to_numpy(dtype=float)
+    qty = holdings['qty'].to_numpy(dtype=float)
+    remaining = avg * qty - holdings['realized_pl'].to_numpy(dtype=float)
+    prices = avg[:, None] * (1 + np.asarray(rates, dtype=float)[None, :] / 100)
+
+    needed = required_sells(remaining, prices, lots)
+    columns = pd.MultiIndex.from_product([list(lots), list(rates)], names=['lot', 'rate'])
+    return pd.DataFrame(needed.transpose(0, 2, 1).reshape(len(holdings), -1), index=holdings.index, columns=columns)
+
+
+def scenario(valued, move=0.0, targets=None, lot=100):
+    # 全体が move% 動いた場合 (targets に {コード: 株価} があればその銘柄はその値) の評価と恩株化の可否
+    price = valued['price'].to_numpy(dtype=float) * (1 + move / 100)
+    if targets:
+        override = valued.index.map(lambda c: targets.get(c, np.nan)).to_numpy(dtype=float)
+        price = np.where(np.isnan(override), price, override)
+
+    qty = valued['qty'].to_numpy(dtype=float)
+    avg = valued['avg_price'].to_numpy(dtype=float)
+    remaining = avg * qty - valued['realized_pl'].to_numpy(dtype=float)
+    needed = required_sells(remaining, price[:, None], [lot])[:, 0, 0]
+
+    return pd.DataFrame({
+        'name': valued['name'].to_numpy(), 'qty': qty, 'price': price,
+        'market_value': price * qty,
+        'unrealized_pl': (price - avg) * qty,
+        'sell_needed': needed,
+        'onkabu': (needed >= 0) & (needed <= qty),
+    }, index=valued.index)
+
+
+def needed_labels(needed, qty, remaining):
+    # 必要売却数 (銘柄数, 条件数) を表示用の文字列にする
+    needed = np.asarray(needed).reshape(len(qty), -1)
+    qty = np.asarray(qty, dtype=float)[:, None]
+    done = np.asarray(remaining, dtype=float)[:, None] <= 0
+    counts = np.vectorize('{:,}株'.format, otypes=[object])(needed)
+    return np.select([done, needed < 0, needed > qty], ["✅ 達成済", "---", "❌ 不可"], counts)
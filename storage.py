@@ -0,0 +1,374 @@
+import atexit
+import base64
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+import perf
+
+# --- 保存先 (GitHub / ローカル) ---
+# PyGithub は読み込みに時間がかかるので、GitHub を使う処理の中で初めて import する
+
+
+class StorageError(Exception):
+    pass
+
+
+def _tree_element(repo, path, data):
+    # テキストはツリーに直接埋め込み、バイナリだけ先に blob を作る
+    from github import InputGitTreeElement
+    if isinstance(data, bytes):
+        perf.count("github.calls")
+        blob = repo.create_git_blob(base64.b64encode(data).decode("ascii"), "base64")
+        return InputGitTreeElement(path, "100644", "blob", sha=blob.sha)
+    return InputGitTreeElement(path, "100644", "blob", content=data)
+
+
+def read_buffer(storage, path, version=None):
+    # 書き換えずに読むためのバッファ。memory map できる保存先ならそれを、できなければ読み込んだ bytes を返す
+    mapper = getattr(storage, "map", None)
+    data = mapper(path) if mapper else None
+    return data if data is not None else storage.read(path, version)
+
+
+def commit_files(repo, files, message, head=None):
+    # 複数ファイルを Git Data API で1つのコミットにまとめて書き込む (tree → commit → ref 更新)。
+    # head に前回の (ref, commit) を渡すとブランチ先頭の取得を省略できる。
+    # 戻り値は新しい head と、書き込んだファイルの blob sha
+    # 別の更新が先に入っていて fast-forward できないときは先頭を取り直して1回だけやり直す
+    from github import GithubException
+    for attempt in range(2):
+        try:
+            if head is None:
+                perf.count("github.calls", 2)
+                ref = repo.get_git_ref(f"heads/{repo.default_branch}")
+                head = (ref, repo.get_git_commit(ref.object.sha))
+            ref, parent = head
+
+            perf.count("github.calls", 3)
+            perf.count("github.bytes_out", sum(len(data) for data in files.values()))
+            elements = [_tree_element(repo, path, data) for path, data in files.items()]
+            tree = repo.create_git_tree(elements, parent.tree)
+            commit = repo.create_git_commit(message, tree, [parent])
+            ref.edit(commit.sha)
+            return (ref, commit), {e.path: e.sha for e in tree.tree if e.path in files}
+        except GithubException as e:
+            if attempt == 0 and e.status in (409, 422):
+                head = None
+                continue
+            raise StorageError(f"GitHub への保存に失敗しました ({e.status}): {e.data}") from e
+        except Exception as e:
+            raise StorageError(f"GitHub への保存に失敗しました: {e}") from e
+
+
+class GitHubClient:
+    # プロセス全体で使い回す GitHub 接続。HTTP 接続はプールして再利用し、
+    # 5xx と二次レート制限には指数バックオフで再試行する。
+    # 残りリクエスト数 (X-RateLimit-Remaining) が min_remaining を切ったら、リセットまで待ってから呼び出す
+    def __init__(self, token, repo_name, pool_size=8, retries=5, backoff=0.5, min_remaining=50, max_wait=60, write_interval=1.0):
+        from github import Auth, Github, GithubRetry
+        retry = GithubRetry(total=retries, backoff_factor=backoff, max_rate_limit_wait=max_wait)
+        self.github = Github(auth=Auth.Token(token), retry=retry, pool_size=pool_size, seconds_between_writes=write_interval)
+        self.repo_name = repo_name
+        self.min_remaining = min_remaining
+        self.max_wait = max_wait
+        self.throttled = 0
+        self._repo = None
+        self._lock = threading.Lock()
+
+    def rate_limit(self):
+        # 直近のレスポンスヘッダーから読んだ残り回数。まだ呼び出していなければ -1
+        remaining, limit = self.github.requester.rate_limiting
+        return {"remaining": remaining, "limit": limit, "reset": self.github.requester.rate_limiting_resettime}
+
+    def throttle(self):
+        rate = self.rate_limit()
+        if rate["remaining"] < 0 or rate["remaining"] >= self.min_remaining: return
+        wait = rate["reset"] - time.time()
+        if wait <= 0: return
+        if wait > self.max_wait:
+            raise StorageError(f"GitHub API の残り回数が少ないため {int(wait)} 秒後まで呼び出しを控えています (残り {rate['remaining']})")
+        self.throttled += 1
+        time.sleep(wait)
+
+    def repo(self):
+        self.throttle()
+        with self._lock:
+            if self._repo is None:
+                try:
+                    self._repo = self.github.get_repo(self.repo_name)
+                except Exception as e:
+                    raise StorageError(f"GitHub リポジトリ {self.repo_name} に接続できません: {e}") from e
+            return self._repo
+
+
+class GitHubStorage:
+    # GitHub リポジトリを保存先にする。repo_factory はリポジトリを返す関数（接続できなければ None）。
+    # ファイルの版は blob sha。確認は ETag 付きの条件付きリクエストで行い、変わっていなければ 304 だけで済ませる
+    def __init__(self, repo_factory, check_interval=5.0, max_blobs=32):
+        self.repo_factory = repo_factory
+        self.check_interval = check_interval
+        self.max_blobs = max_blobs
+        self._head = None
+        self._stats = {}
+        self._blobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _repo(self):
+        repo = self.repo_factory()
+        if not repo: raise StorageError("GitHub に接続できません")
+        return repo
+
+    def _remember(self, sha, data):
+        with self._lock:
+            self._blobs[sha] = data
+            self._blobs.move_to_end(sha)
+            while len(self._blobs) > self.max_blobs: self._blobs.popitem(last=False)
+
+    def version(self, path):
+        with self._lock:
+            hit = self._stats.get(path)
+        if hit and time.monotonic() - hit[0] < self.check_interval: return hit[2]
+
+        try:
+            repo = self._repo()
+            headers = {"If-None-Match": hit[1]} if hit and hit[1] else {}
+            with perf.span("github.version", path=path):
+                status, resp_headers, output = repo.requester.requestJson("GET", f"{repo.url}/contents/{quote(path)}", headers=headers)
+            perf.count("github.calls")
+            perf.count("github.bytes_in", len(output or ""))
+        except StorageError:
+            raise
+        except Exception as e:
+            raise StorageError(f"{path} を GitHub で確認できませんでした: {e}") from e
+
+        etag = resp_headers.get("etag")
+        if status == 304: sha = hit[2]
+        elif status == 404: sha = None
+        elif status >= 400: raise StorageError(f"{path} を GitHub で確認できませんでした ({status}): {output}")
+        else:
+            body = json.loads(output)
+            sha = body["sha"]
+            if body.get("encoding") == "base64" and body.get("content"):
+                self._remember(sha, base64.b64decode(body["content"]))
+        with self._lock:
+            self._stats[path] = (time.monotonic(), etag, sha)
+        return sha
+
+    def read(self, path, version=None):
+        version = version or self.version(path)
+        if version is None: return None
+        with self._lock:
+            data = self._blobs.get(version)
+        if data is not None: return data
+        try:
+            with perf.span("github.read", path=path):
+                blob = self._repo().get_git_blob(version)
+            perf.count("github.calls")
+            perf.count("github.bytes_in", len(blob.content))
+        except StorageError:
+            raise
+        except Exception as e:
+            raise StorageError(f"{path} を GitHub から読み込めませんでした: {e}") from e
+        data = base64.b64decode(blob.content)
+        self._remember(version, data)
+        return data
+
+    def write(self, files, message):
+        with self._write_lock, perf.span("github.write", files=list(files)):
+            try:
+                self._head, shas = commit_files(self._repo(), files, message, self._head)
+            except StorageError:
+                self._head = None
+                raise
+        # 書いた内容はそのまま覚えておき、次の読み込みで取り直さない
+        for path, sha in shas.items():
+            data = files[path]
+            self._remember(sha, data.encode("utf-8") if isinstance(data, str) else data)
+        with self._lock:
+            for path, sha in shas.items(): self._stats[path] = (time.monotonic(), None, sha)
+
+    def append(self, path, text, message):
+        # GitHub には追記の API がないので、末尾に足した内容で書き直す
+        current = self.read(path) or b""
+        self.write({path: current.decode("utf-8") + text}, message)
+
+
+class LocalStorage:
+    # ローカルのフォルダを保存先にする。一時ファイルに書いてから置き換える
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def version(self, path):
+        try:
+            st = os.stat(os.path.join(self.root, path))
+        except FileNotFoundError:
+            return None
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+    def read(self, path, version=None):
+        try:
+            with open(os.path.join(self.root, path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def map(self, path):
+        # 読み取り専用の memory map (写さずに読める)。ファイルが無い・空なら None
+        try:
+            with open(os.path.join(self.root, path), "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, files, message):
+        with self._lock:
+            try:
+                staged = []
+                for path, data in files.items():
+                    full = os.path.join(self.root, path)
+                    os.makedirs(os.path.dirname(full), exist_ok=True)
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(full), prefix=".tmp-")
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+                    staged.append((tmp, full))
+                for tmp, full in staged:
+                    os.replace(tmp, full)
+            except OSError as e:
+                raise StorageError(f"ローカルへの保存に失敗しました: {e}") from e
+
+    def append(self, path, text, message):
+        with self._lock:
+            try:
+                with open(os.path.join(self.root, path), "a", encoding="utf-8") as f:
+                    f.write(text)
+            except OSError as e:
+                raise StorageError(f"ローカルへの追記に失敗しました: {e}") from e
+
+
+class WriteBehindStorage:
+    # 書き込みをためておき、delay 秒のあいだ次の書き込みがなければ inner へまとめて流す。
+    # 失敗したときは内容を戻して last_error に残し、次の書き込みか終了時に再送する
+    def __init__(self, inner, delay=3.0):
+        self.inner = inner
+        self.delay = delay
+        self.last_error = None
+        self._pending = {}
+        self._appends = {}
+        self._generation = 0
+        self._messages = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def version(self, path):
+        with self._lock:
+            if path in self._pending or path in self._appends: return f"pending:{self._generation}"
+        return self.inner.version(path)
+
+    def read(self, path, version=None):
+        with self._lock:
+            data = self._pending.get(path)
+            appended = "".join(self._appends.get(path, []))
+        if data is None: data = self.inner.read(path)
+        if isinstance(data, str): data = data.encode("utf-8")
+        if appended: data = (data or b"") + appended.encode("utf-8")
+        return data
+
+    def _schedule(self, message):
+        self._generation += 1
+        self._messages.append(message)
+        if self._timer: self._timer.cancel()
+        self._timer = threading.Timer(self.delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def write(self, files, message):
+        with self._lock:
+            self._pending.update(files)
+            for path in files: self._appends.pop(path, None)
+            self._schedule(message)
+
+    def append(self, path, text, message):
+        with self._lock:
+            self._appends.setdefault(path, []).append(text)
+            self._schedule(message)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer: self._timer.cancel()
+                self._timer = None
+                files, appends, messages = self._pending, self._appends, self._messages
+                self._pending, self._appends, self._messages = {}, {}, []
+            if not files and not appends: return
+
+            message = messages[0] if len(messages) == 1 else f"{len(messages)} 件の更新をまとめて保存\n\n" + "\n".join(messages)
+            try:
+                # 追記分は現在の内容に足してから、書き込みと合わせて1回で流す
+                merged = dict(files)
+                for path, texts in appends.items():
+                    base = merged.get(path)
+                    if base is None: base = self.inner.read(path) or b""
+                    if isinstance(base, bytes): base = base.decode("utf-8")
+                    merged[path] = base + "".join(texts)
+                self.inner.write(merged, message)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e if isinstance(e, StorageError) else StorageError(str(e))
+                with self._lock:
+                    for path, texts in appends.items():
+                        if path not in self._pending: self._appends[path] = texts + self._appends.get(path, [])
+                    self._pending = {**files, **self._pending}
+                    self._messages = messages + self._messages
+
+    def pending(self):
+        with self._lock:
+            return sorted(set(self._pending) | set(self._appends))
+
+
+class ReplicatedStorage:
+    # primary に同期で書き込み、replica へは WriteBehindStorage を通して後から複製する。
+    # primary に書けた時点で保存は成功とし、replica の失敗は last_error に残して次の書き込みで再送する。
+    # primary に無いファイルは replica から読んで primary に取り込む
+    def __init__(self, primary, replica):
+        self.primary = primary
+        self.replica = replica if isinstance(replica, WriteBehindStorage) else WriteBehindStorage(replica, delay=0)
+
+    @property
+    def last_error(self):
+        return self.replica.last_error
+
+    def pending(self):
+        return self.replica.pending()
+
+    def version(self, path):
+        return self.primary.version(path) or self.replica.version(path)
+
+    def read(self, path, version=None):
+        data = self.primary.read(path)
+        if data is None:
+            data = self.replica.read(path)
+            if data is not None: self.primary.write({path: data}, f"Import {path}")
+        return data
+
+    def map(self, path):
+        mapper = getattr(self.primary, "map", None)
+        return mapper(path) if mapper else None
+
+    def write(self, files, message):
+        self.primary.write(files, message)
+        self.replica.write(files, message)
+
+    def append(self, path, text, message):
+        self.primary.append(path, text, message)
+        self.replica.append(path, text, message)
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+# --- 評価額の計算 ---
+# 保有銘柄と株価を列で突き合わせ、派生する列を全銘柄まとめて計算する。
+# 表示用の文字列にするのは画面に出す直前 (format_holdings) だけ
+
+FEE_RATE = 0.15
+HOLDING_COLUMNS = ['name', 'qty', 'avg_price', 'realized_pl', 'original_avg']
+QUOTE_COLUMNS = ['quote_name', 'price', 'change', 'pct']
+DISPLAY_COLUMNS = ['証券コード', '銘柄名', '現在値', '前日比', '保有株数', '平均取得単価', '騰落率', '含み損益', '保有元本', 'ステータス']
+
+
+def holdings_frame(portfolio):
+    # portfolio (dict) のうち保有数が残っている銘柄だけを、元の並び順のまま表にする
+    df = pd.DataFrame.from_dict(portfolio, orient='index')
+    if df.empty: return pd.DataFrame(columns=HOLDING_COLUMNS)
+    if 'original_avg' not in df.columns: df['original_avg'] = np.nan
+    df = df[df['qty'] > 0][HOLDING_COLUMNS]
+    df.index = df.index.astype(str)
+    df.index.name = 'code'
+    return df
+
+
+def quotes_frame(quotes, status=None):
+    # {コード: (銘柄名, 現在値, 前日比, 騰落率%)} を表にする。status は {コード: fresh / stale / pending}
+    df = pd.DataFrame.from_dict(quotes, orient='index', columns=QUOTE_COLUMNS)
+    df[['price', 'change', 'pct']] = df[['price', 'change', 'pct']].astype(float)
+    if status is not None: df['status'] = pd.Series(status, dtype=object)
+    return df
+
+
+def value_holdings(holdings, quotes):
+    df = holdings.join(quotes, how='left')
+    qty = df['qty'].to_numpy(dtype=float)
+    avg = df['avg_price'].to_numpy(dtype=float)
+    realized = df['realized_pl'].to_numpy(dtype=float)
+    price = df['price'].fillna(0).to_numpy(dtype=float)
+
+    cost = qty * avg
+    error = price == 0
+    # 騰落率は「元の平均取得単価」基準。記録がなければ今の平均取得単価を使う
+    base = df['original_avg'].fillna(df['avg_price']).to_numpy(dtype=float)
+    base = np.where(base == 0, avg, base)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(base > 0, (price - base) / base * 100, 0.0)
+
+    df['name'] = df['quote_name'].fillna(df['name'])
+    df['price'] = price
+    df['change'] = df['change'].fillna(0)
+    df['pct'] = df['pct'].fillna(0)
+    df['cost'] = cost
+    df['data_error'] = error
+    df['unrealized_pl'] = np.where(error, 0.0, (price - avg) * qty)
+    df['unrealized_pct'] = np.where(error, 0.0, pct)
+    df['free'] = avg == 0
+    df['onkabu'] = realized >= cost
+    df['remaining'] = cost - realized
+    df['onkabu_value'] = np.where(df['free'] & ~error, price * qty, 0.0)
+    return df.drop(columns='quote_name')
+
+
+def _marks(values, up="🔺", down="▼", flat="➖"):
+    return np.select([values > 0, values < 0], [up, down], flat)
+
+
+def _ints(values):
+    # int() と同じく 0 方向に切り捨てる
+    return np.trunc(values).astype('int64')
+
+
+def format_holdings(valued):
+    # 画面表示用の文字列の表。列名は従来の表示と同じ
+    if valued.empty: return pd.DataFrame(columns=DISPLAY_COLUMNS)
+    error = valued['data_error'].to_numpy()
+    price = valued['price'].to_numpy()
+    change = valued['change'].to_numpy(dtype=float)
+    pl = valued['unrealized_pl'].to_numpy()
+    pct = valued['unrealized_pct'].to_numpy()
+    na = pd.Series("---", index=valued.index)
+
+    price_str = pd.Series(_ints(price), index=valued.index).map('{:,}円'.format)
+    status = valued['status'] if 'status' in valued.columns else pd.Series("fresh", index=valued.index)
+    price_str = price_str.where(status != "stale", price_str + " 🕒")
+    failed = pd.Series("⚠️ 取得失敗", index=valued.index).where(status != "pending", "⏳ 取得中")
+    change_str = (pd.Series(_marks(change), index=valued.index) + " " + pd.Series(_ints(change), index=valued.index).astype(str)
+                  + valued['pct'].map(' ({:+.2f}%)'.format))
+    pl_str = pd.Series(_marks(pl), index=valued.index) + " " + pd.Series(_ints(pl), index=valued.index).map('{:,}'.format)
+    pct_str = pd.Series(np.where(pct > 0, "+", ""), index=valued.index) + valued['unrealized_pct'].map('{:.2f}%'.format)
+
+    remaining = pd.Series(_ints(valued['remaining'].to_numpy()), index=valued.index).map('あと{:,}円'.format)
+    onkabu = remaining.where(~valued['onkabu'], "🏆完全恩株達成！").where(~valued['free'], "👑 恩株 (コスト0円)")
+
+    return pd.DataFrame({
+        '証券コード': valued.index, '銘柄名': valued['name'].to_numpy(),
+        '現在値': price_str.where(~error, failed).to_numpy(),
+        '前日比': change_str.where(~error, na).to_numpy(),
+        '保有株数': valued['qty'].to_numpy(),
+        '平均取得単価': valued['avg_price'].map('{:,.0f}'.format).to_numpy(),
+        '騰落率': pct_str.where(~error, na).to_numpy(),
+        '含み損益': pl_str.where(~error, na).to_numpy(),
+        '保有元本': pd.Series(_ints(valued['cost'].to_numpy()), index=valued.index).map('{:,}'.format).to_numpy(),
+        'ステータス': onkabu.to_numpy(),
+    })
+
+
+def fee_summary(trades, onkabu_value=0, rate=FEE_RATE):
+    # 成功報酬の集計。通常の確定損益と恩株ボーナス分を分けて合計する (銭単位で足してから円にする)
+    total_pl = sum(t.pl for t in trades if not t.bonus) / 100
+    bonus_base_profit = sum(t.pl for t in trades if t.bonus) / 100
+    return {
+        'total_pl': total_pl,
+        'bonus_base_profit': bonus_base_profit,
+        'real_status': total_pl + onkabu_value,
+        'reward': total_pl * rate,
+        'bonus_reward': bonus_base_profit * rate,
+    }